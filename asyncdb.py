@@ -0,0 +1,84 @@
+#!/usr/bin/python
+'''Non-blocking access to a pymongo database from tornado handlers
+
+Every call runs in a thread pool and returns an awaitable, so a slow
+round-trip to mongod never stalls the IOLoop. The API follows Motor's:
+
+    doc = await self.db.models.find_one({"dsid": dsid})
+    docs = await self.db.labeledinstances.find({"dsid": dsid}).to_list(None)
+
+Anything with a synchronous pymongo interface (a MongoClient database,
+a mongomock database in tests) can be wrapped.
+'''
+
+from functools import partial
+
+from tornado.ioloop import IOLoop
+
+
+class AsyncCursor():
+    '''Wraps a pymongo cursor, chain it as usual and await to_list'''
+    def __init__(self, cursor, executor):
+        self.delegate = cursor
+        self.executor = executor
+
+    def __getattr__(self, name):
+        # sort, limit, skip, batch_size, ... only configure the cursor
+        attr = getattr(self.delegate, name)
+        if not callable(attr):
+            return attr
+        def chain(*args, **kwargs):
+            res = attr(*args, **kwargs)
+            return self if res is self.delegate else res
+        return chain
+
+    def to_list(self, length=None):
+        '''All remaining documents (or the next length of them)'''
+        if length is None:
+            return self._run(list, self.delegate)
+        return self._run(lambda cursor: [doc for _, doc in zip(range(length), cursor)], self.delegate)
+
+    def _run(self, fn, *args):
+        return IOLoop.current().run_in_executor(self.executor, fn, *args)
+
+
+class AsyncCollection():
+    '''Wraps a pymongo collection, blocking methods return awaitables'''
+    def __init__(self, collection, executor):
+        self.delegate = collection
+        self.executor = executor
+
+    def __getattr__(self, name):
+        attr = getattr(self.delegate, name)
+        if not callable(attr):
+            return attr
+        return partial(self._run, attr)
+
+    def find(self, *args, **kwargs):
+        # creating a cursor does not talk to the server, iterating it does
+        return AsyncCursor(self.delegate.find(*args, **kwargs), self.executor)
+
+    def run(self, fn, *args, **kwargs):
+        '''Run a blocking fn(collection, *args, **kwargs) off the IOLoop,
+           e.g. to stream a large cursor into an array without building a
+           list of documents first
+        '''
+        return self._run(fn, self.delegate, *args, **kwargs)
+
+    def _run(self, fn, *args, **kwargs):
+        return IOLoop.current().run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+
+class AsyncDatabase():
+    '''Wraps a pymongo database, collections are attributes as usual'''
+    def __init__(self, database, executor):
+        self.delegate = database
+        self.executor = executor
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        return AsyncCollection(self.delegate[name], self.executor)
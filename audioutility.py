@@ -1,78 +1,299 @@
 
 
+from functools import lru_cache
+import io
+import time
+
 import numpy
+from numpy.lib.stride_tricks import as_strided
 from scipy.fftpack import dct
+import scipy.io.wavfile
+
+# apply_batch stacks this many bytes of frames per vectorized pass
+BATCH_CHUNK_BYTES = 4 * 1024 * 1024
+
+# largest absolute difference we accept between dtype=float32 and float64 mfccs
+# (coefficients are O(100), measured differences are ~1e-3, worst seen ~1e-2)
+MFCC_FLOAT32_ATOL = 0.05
+
+# callables hook(sample_rate, clips, seconds) run after every get_filter_mfcc
+# and batch_mfcc call, e.g. to collect timings (see metrics.Metrics.watch_mfcc)
+MFCC_HOOKS = []
 
 class AudioUtility():
     def __init__(self, signal=None, sample_rate=None):
         self.signal = signal
         self.sample_rate = sample_rate
 
+    def has_enough_data(self, subsample_length=3.5):
+        '''True if get_filter_mfcc(subsample_length) will not run out of signal
+        '''
+        return int(subsample_length * self.sample_rate) <= len(self.signal)
+
     # Disclaimer: Source code for get_mfcc was adapted from Haytham Fayek's example
     # http://haythamfayek.com/2016/04/21/speech-processing-for-machine-learning.html
-    def get_filter_mfcc(self, subsample_length=3.5, pre_emphasis=0.97, frame_size=0.025, frame_stride=0.01, NFFT=512, nfilt = 40, num_ceps=12, cep_lifter=22):
+    #
+    # dtype=numpy.float32 runs the whole pipeline in single precision: about half
+    # the memory traffic, and the mfcc stays within MFCC_FLOAT32_ATOL of the
+    # float64 result for 16 bit audio scaled the way the handlers scale it
+    def get_filter_mfcc(self, subsample_length=3.5, pre_emphasis=0.97, frame_size=0.025, frame_stride=0.01, NFFT=512, nfilt = 40, num_ceps=12, cep_lifter=22, dtype=numpy.float64):
+        #everything that does not depend on the signal itself is cached in a plan
+        plan = get_mfcc_plan(self.sample_rate, subsample_length, frame_size, frame_stride, NFFT, nfilt, num_ceps, cep_lifter, numpy.dtype(dtype))
+
         #make sure we have enough data
-        if int(subsample_length * self.sample_rate) > len(self.signal):
+        if plan.signal_length > len(self.signal):
             raise IndexError("Provided sample was not long enough")
-        
-        #take the first <subsample_length> seconds from AudioUtility's signal
-        #keep function's own signal
-        signal = self.signal[0:int(subsample_length * self.sample_rate)]
-        
-        #separate high frequencies from low frequencies
-        # emphasized_signal = numpy.append(signal[0], signal[1:] - pre_emphasis * signal[:-1])
+
+        start = time.perf_counter()
+        res = plan.apply(self.signal)
+        for hook in MFCC_HOOKS:
+            hook(self.sample_rate, 1, time.perf_counter() - start)
+        return res
+
+
+def mel_filterbank(sample_rate, NFFT=512, nfilt=40):
+    '''Triangular filters equally spaced on the mel scale,
+       shape is (nfilt, NFFT/2 + 1)
+    '''
+    low_freq_mel = 0
+    high_freq_mel = (2595 * numpy.log10(1 + (sample_rate / 2) / 700))  # Convert Hz to Mel
+    mel_points = numpy.linspace(low_freq_mel, high_freq_mel, nfilt + 2)  # Equally spaced in Mel scale
+    hz_points = (700 * (10**(mel_points / 2595) - 1))  # Convert Mel to Hz
+    bin = numpy.floor((NFFT + 1) * hz_points / sample_rate)
+
+    fbank = numpy.zeros((nfilt, int(numpy.floor(NFFT / 2 + 1))))
+    for m in range(1, nfilt + 1):
+        f_m_minus = int(bin[m - 1])   # left
+        f_m = int(bin[m])             # center
+        f_m_plus = int(bin[m + 1])    # right
+
+        for k in range(f_m_minus, f_m):
+            fbank[m - 1, k] = (k - bin[m - 1]) / (bin[m] - bin[m - 1])
+        for k in range(f_m, f_m_plus):
+            fbank[m - 1, k] = (bin[m + 1] - k) / (bin[m + 1] - bin[m])
+    return fbank
+
+
+class MfccPlan():
+    '''Everything in the MFCC pipeline that only depends on the parameters
+       (frame geometry, window, filterbank, lifter). Build once with
+       get_mfcc_plan and reuse, only the FFT/dot/DCT run per signal.
+    '''
+    def __init__(self, sample_rate, subsample_length=3.5, frame_size=0.025, frame_stride=0.01, NFFT=512, nfilt=40, num_ceps=12, cep_lifter=22, dtype=numpy.float64):
+        self.sample_rate = sample_rate
+        self.dtype = numpy.dtype(dtype)
+        self.NFFT = NFFT
+        self.nfilt = nfilt
+        self.num_ceps = num_ceps
+        self.signal_length = int(subsample_length * sample_rate)
 
         #frame the signal
-        frame_length, frame_step = frame_size * self.sample_rate, frame_stride * self.sample_rate  # Convert from seconds to samples
-        signal_length = len(signal)
-        frame_length = int(round(frame_length))
-        frame_step = int(round(frame_step))
-        num_frames = int(numpy.ceil(float(numpy.abs(signal_length - frame_length)) / frame_step))  # Make sure that we have at least 1 frame
-        pad_signal_length = num_frames * frame_step + frame_length
-        z = numpy.zeros((pad_signal_length - signal_length))
-        pad_signal = numpy.append(signal, z) # Pad Signal to make sure that all frames have equal number of samples without truncating any samples from the original signal
-        indices = numpy.tile(numpy.arange(0, frame_length), (num_frames, 1)) + numpy.tile(numpy.arange(0, num_frames * frame_step, frame_step), (frame_length, 1)).T
-        frames = pad_signal[indices.astype(numpy.int32, copy=False)]
-
-        #apply hamming window
-        frames *= numpy.hamming(frame_length)
+        frame_length, frame_step = frame_size * sample_rate, frame_stride * sample_rate  # Convert from seconds to samples
+        self.frame_length = int(round(frame_length))
+        self.frame_step = int(round(frame_step))
+        self.num_frames = int(numpy.ceil(float(numpy.abs(self.signal_length - self.frame_length)) / self.frame_step))  # Make sure that we have at least 1 frame
+        self.pad_signal_length = self.num_frames * self.frame_step + self.frame_length
+        # rfft(frames, NFFT) only looks at the first NFFT samples of a frame,
+        # so there is no point windowing (or even reading) the rest
+        self.fft_length = min(self.frame_length, NFFT)
+
+        self.window = numpy.hamming(self.frame_length)[:self.fft_length].astype(self.dtype)
+        self.fbank = mel_filterbank(sample_rate, NFFT, nfilt).astype(self.dtype)
+
+        #sinusoidal liftering improves speech recognition in noisy signals
+        n = numpy.arange(num_ceps)
+        self.lift = (1 + (cep_lifter / 2) * numpy.sin(numpy.pi * n / cep_lifter)).astype(self.dtype)
+
+        #plans are shared between requests, nobody gets to change them
+        for arr in (self.window, self.fbank, self.lift):
+            arr.flags.writeable = False
+
+    def apply(self, signal):
+        '''Return (filter_banks, mfcc) for the first signal_length samples of signal
+        '''
+        # Pad Signal to make sure that all frames have equal number of samples without truncating any samples from the original signal
+        # (this is the only copy of the signal we make, it also does the dtype conversion)
+        pad_signal = numpy.zeros(self.pad_signal_length, dtype=self.dtype)
+        pad_signal[:self.signal_length] = signal[0:self.signal_length]
+        return self._transform(pad_signal)
+
+    def apply_batch(self, signals, chunk_size=None):
+        '''Same as apply for a 2-D array or a list of signals, every step runs
+           over a stack of chunk_size clips at a time. By default chunks are
+           sized so their frames stay around BATCH_CHUNK_BYTES, bigger stacks
+           spill out of cache and get slower per clip, not faster.
+           Returns arrays of shape (batch, frames, nfilt) and (batch, frames, ceps)
+        '''
+        if chunk_size is None:
+            chunk_size = max(1, BATCH_CHUNK_BYTES // (self.num_frames * self.fft_length * self.dtype.itemsize))
+        for i, signal in enumerate(signals):
+            if len(signal) < self.signal_length:
+                raise IndexError("Provided sample %d was not long enough" % i)
+
+        filter_banks, mfcc = [], []
+        for start in range(0, len(signals), chunk_size):
+            chunk = signals[start:start + chunk_size]
+            pad_signal = numpy.zeros((len(chunk), self.pad_signal_length), dtype=self.dtype)
+            if isinstance(chunk, numpy.ndarray):
+                pad_signal[:, :self.signal_length] = chunk[:, 0:self.signal_length]
+            else:
+                for i, signal in enumerate(chunk):
+                    pad_signal[i, :self.signal_length] = signal[0:self.signal_length]
+            f, m = self._transform(pad_signal)
+            filter_banks.append(f)
+            mfcc.append(m)
+
+        if not mfcc:
+            return (numpy.zeros((0, self.num_frames, self.nfilt), dtype=self.dtype), numpy.zeros((0, self.num_frames, min(self.num_ceps, self.nfilt - 1)), dtype=self.dtype))
+        return (numpy.concatenate(filter_banks), numpy.concatenate(mfcc))
+
+    def frames(self, pad_signal):
+        '''Read-only strided view of pad_signal, shape (..., num_frames, fft_length),
+           overlapping frames share memory with pad_signal instead of being copied
+        '''
+        itemsize = pad_signal.strides[-1]
+        return as_strided(pad_signal,
+                          shape=pad_signal.shape[:-1] + (self.num_frames, self.fft_length),
+                          strides=pad_signal.strides[:-1] + (self.frame_step * itemsize, itemsize),
+                          writeable=False)
+
+    def _transform(self, pad_signal):
+        '''The signal dependent steps, pad_signal is (..., pad_signal_length)
+        '''
+        filter_banks, mfcc = self.frame_features(self.frames(pad_signal))
+        return self.normalize(filter_banks, mfcc)
+
+    def frame_features(self, frames):
+        '''(filter_banks, mfcc) of frames (..., fft_length) before mean
+           normalization, every frame is independent of the others
+        '''
+        #apply hamming window (first materialized copy of the frames)
+        frames = frames * self.window
 
         #Apply Fourier-Transform and Power Spectrum
-        mag_frames = numpy.absolute(numpy.fft.rfft(frames, NFFT))
-        pow_frames = ((1.0 / NFFT) * ((mag_frames) ** 2)) 
+        mag_frames = numpy.absolute(numpy.fft.rfft(frames, self.NFFT)).astype(self.dtype, copy=False)
+        pow_frames = ((1.0 / self.NFFT) * ((mag_frames) ** 2))
 
         #Apply Filters
-        low_freq_mel = 0
-        high_freq_mel = (2595 * numpy.log10(1 + (self.sample_rate / 2) / 700))  # Convert Hz to Mel
-        mel_points = numpy.linspace(low_freq_mel, high_freq_mel, nfilt + 2)  # Equally spaced in Mel scale
-        hz_points = (700 * (10**(mel_points / 2595) - 1))  # Convert Mel to Hz
-        bin = numpy.floor((NFFT + 1) * hz_points / self.sample_rate)
-
-        fbank = numpy.zeros((nfilt, int(numpy.floor(NFFT / 2 + 1))))
-        for m in range(1, nfilt + 1):
-            f_m_minus = int(bin[m - 1])   # left
-            f_m = int(bin[m])             # center
-            f_m_plus = int(bin[m + 1])    # right
-
-            for k in range(f_m_minus, f_m):
-                fbank[m - 1, k] = (k - bin[m - 1]) / (bin[m] - bin[m - 1])
-            for k in range(f_m, f_m_plus):
-                fbank[m - 1, k] = (bin[m + 1] - k) / (bin[m + 1] - bin[m])
-        filter_banks = numpy.dot(pow_frames, fbank.T)
-        filter_banks = numpy.where(filter_banks == 0, numpy.finfo(float).eps, filter_banks)  # Numerical Stability
+        filter_banks = numpy.dot(pow_frames.reshape(-1, pow_frames.shape[-1]), self.fbank.T).reshape(pow_frames.shape[:-1] + (-1,))
+        filter_banks[filter_banks == 0] = numpy.finfo(float).eps  # Numerical Stability
         filter_banks = 20 * numpy.log10(filter_banks)  # dB
 
         #MFC Coefficients
-        mfcc = dct(filter_banks, type=2, axis=1, norm='ortho')[:, 1 : (num_ceps + 1)] # Keep 2-13
+        mfcc = dct(filter_banks, type=2, axis=-1, norm='ortho')[..., 1 : (self.num_ceps + 1)].astype(self.dtype, copy=False) # Keep 2-13
+        mfcc *= self.lift[:mfcc.shape[-1]]  #*
+        return (filter_banks, mfcc)
 
-        #sinusoidal liftering improves speech recognition in noisy signals
-        (nframes, ncoeff) = mfcc.shape
-        n = numpy.arange(ncoeff)
-        lift = 1 + (cep_lifter / 2) * numpy.sin(numpy.pi * n / cep_lifter)
-        mfcc *= lift  #*
+    def normalize(self, filter_banks, mfcc):
+        '''Mean-normalize frame_features in place, per clip over its frames
+        '''
+        filter_banks -= (numpy.mean(filter_banks, axis=-2, keepdims=True) + 1e-8)
+        mfcc -= (numpy.mean(mfcc, axis=-2, keepdims=True) + 1e-8)
+
+        return (filter_banks, mfcc)
+
+
+class MfccStream():
+    '''MfccPlan.apply for audio that arrives in chunks. feed() transforms
+       every frame the samples so far complete, carrying the overlap with
+       the next frames over in a small buffer, so once the clip is
+       complete only the mean normalization is left. result() matches
+       plan.apply() on the whole clip
+    '''
+    def __init__(self, plan):
+        self.plan = plan
+        self.received = 0 # samples of this clip so far, at most signal_length
+        self.buffer = numpy.zeros(0, dtype=plan.dtype) # samples from the next frame on
+        self.next_frame = 0
+        self.filter_banks = []
+        self.mfcc = []
+
+    @property
+    def complete(self):
+        return self.next_frame == self.plan.num_frames
+
+    def feed(self, samples):
+        '''Add samples, returns the ones past the end of the clip
+           (empty unless it is complete)
+        '''
+        plan = self.plan
+        room = plan.signal_length - self.received
+        samples, rest = samples[:room], samples[room:]
+        self.received += len(samples)
+        parts = [self.buffer, numpy.asarray(samples, dtype=plan.dtype)]
+        if self.received == plan.signal_length:
+            # zero padded to pad_signal_length, like apply()
+            start = self.next_frame * plan.frame_step
+            parts.append(numpy.zeros(plan.pad_signal_length - start - len(self.buffer) - len(samples), dtype=plan.dtype))
+        self.buffer = numpy.concatenate(parts)
+
+        if len(self.buffer) >= plan.fft_length and not self.complete:
+            count = min((len(self.buffer) - plan.fft_length) // plan.frame_step + 1, plan.num_frames - self.next_frame)
+            frames = as_strided(self.buffer, shape=(count, plan.fft_length),
+                                strides=(plan.frame_step * self.buffer.strides[0], self.buffer.strides[0]),
+                                writeable=False)
+            filter_banks, mfcc = plan.frame_features(frames)
+            self.filter_banks.append(filter_banks)
+            self.mfcc.append(mfcc)
+            self.next_frame += count
+            self.buffer = self.buffer[count * plan.frame_step:].copy()
+        return rest
+
+    def result(self):
+        '''(filter_banks, mfcc) of the complete clip'''
+        if not self.complete:
+            raise IndexError("Provided sample was not long enough")
+        return self.plan.normalize(numpy.concatenate(self.filter_banks), numpy.concatenate(self.mfcc))
+
+
+# plans only depend on the parameter tuple, keep the recently used ones around
+@lru_cache(maxsize=32)
+def get_mfcc_plan(sample_rate, subsample_length=3.5, frame_size=0.025, frame_stride=0.01, NFFT=512, nfilt=40, num_ceps=12, cep_lifter=22, dtype=numpy.dtype(numpy.float64)):
+    return MfccPlan(sample_rate, subsample_length, frame_size, frame_stride, NFFT, nfilt, num_ceps, cep_lifter, dtype)
+
+
+def batch_mfcc(signals, sample_rate, subsample_length=3.5, frame_size=0.025, frame_stride=0.01, NFFT=512, nfilt=40, num_ceps=12, cep_lifter=22, dtype=numpy.float64):
+    '''MFCCs for many signals recorded at the same sample_rate in one
+       vectorized pass. signals is a 2-D array or a list of 1-D signals,
+       returns a (batch, frames, ceps) array whose rows match
+       AudioUtility(signal, sample_rate).get_filter_mfcc(...)[1]
+    '''
+    plan = get_mfcc_plan(sample_rate, subsample_length, frame_size, frame_stride, NFFT, nfilt, num_ceps, cep_lifter, numpy.dtype(dtype))
+    start = time.perf_counter()
+    filter_banks, mfcc = plan.apply_batch(signals)
+    for hook in MFCC_HOOKS:
+        hook(sample_rate, len(signals), time.perf_counter() - start)
+    return mfcc
+
+
+# little-endian raw PCM layouts accepted by decode_pcm and their full scale
+PCM_FORMATS = {
+    'float32': (numpy.dtype('<f4'), 1.0),
+    'int16':   (numpy.dtype('<i2'), 32768.0),
+}
 
-        #mean-normalize
-        filter_banks -= (numpy.mean(filter_banks, axis=0) + 1e-8)
-        mfcc -= (numpy.mean(mfcc, axis=0) + 1e-8)
+def decode_pcm(buf, sample_format='float32'):
+    '''Mono little-endian PCM bytes -> float32 signal in [-1, 1], the same
+       range the JSON clients send. float32 bodies are not copied (the
+       returned array is a read-only view of buf)
+    '''
+    if sample_format not in PCM_FORMATS:
+        raise ValueError("Unknown sample format %s" % sample_format)
+    dtype, full_scale = PCM_FORMATS[sample_format]
+    signal = numpy.frombuffer(buf, dtype=dtype)
+    if full_scale != 1.0:
+        signal = numpy.multiply(signal, 1.0 / full_scale, dtype=numpy.float32)
+    return signal.astype(numpy.float32, copy=False)
 
-        return (filter_banks, mfcc)
\ No newline at end of file
+def decode_wav(buf):
+    '''WAV file bytes -> (sample_rate, float32 signal in [-1, 1]),
+       only the first channel is kept
+    '''
+    sample_rate, signal = scipy.io.wavfile.read(io.BytesIO(buf))
+    if signal.ndim > 1:
+        signal = signal[:, 0]
+    if signal.dtype == numpy.uint8:
+        signal = numpy.multiply(signal, 1.0 / 128, dtype=numpy.float32) - 1
+    elif signal.dtype.kind == 'i':
+        signal = numpy.multiply(signal, 1.0 / (1 << (8 * signal.dtype.itemsize - 1)), dtype=numpy.float32)
+    return sample_rate, signal.astype(numpy.float32, copy=False)
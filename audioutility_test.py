@@ -8,4 +8,31 @@ filter, mfcc = au.get_filter_mfcc()
 print(mfcc.shape)
 print(mfcc[0])
 print("-------")
-print(mfcc.flatten())
\ No newline at end of file
+print(mfcc.flatten())
+
+def test_batch_matches_single():
+    from audioutility import batch_mfcc
+    clips = np.stack([signal[i * 4000:i * 4000 + 30000] for i in range(3)])
+    mfccs = batch_mfcc(clips, sample_rate)
+    assert mfccs.shape == (3,) + mfcc.shape
+    for clip, batched in zip(clips, mfccs):
+        assert np.array_equal(AudioUtility(signal=clip, sample_rate=sample_rate).get_filter_mfcc()[1], batched)
+
+
+def test_float32_within_tolerance():
+    from audioutility import MFCC_FLOAT32_ATOL
+    filter32, mfcc32 = au.get_filter_mfcc(dtype=np.float32)
+    assert mfcc32.dtype == np.float32
+    assert np.allclose(mfcc32, mfcc, rtol=0, atol=MFCC_FLOAT32_ATOL)
+
+
+def test_stream_matches_whole_clip():
+    from audioutility import MfccStream, get_mfcc_plan
+    plan = get_mfcc_plan(sample_rate)
+    stream = MfccStream(plan)
+    rest = []
+    for start in range(0, len(signal), 1234):
+        rest.append(stream.feed(signal[start:start + 1234]))
+    assert stream.complete
+    assert sum(map(len, rest)) == len(signal) - plan.signal_length
+    assert np.allclose(stream.result()[1], mfcc, rtol=0, atol=1e-9)
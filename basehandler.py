@@ -15,10 +15,17 @@ import decimal
 import json
 import os
 import os.path
+import time
 
 from grp import getgrnam
 from pwd import getpwnam
 
+from audioutility import decode_pcm, decode_wav
+from metrics import StageTimer
+
+WAV_CONTENT_TYPES = ('audio/wav', 'audio/x-wav', 'audio/wave')
+PCM_CONTENT_TYPES = ('application/octet-stream',)
+
 
 def json_str(value):
     return str(json.dumps(recursive_unicode(value), cls=CustomJSONEncoder).replace("</", "<\\/"))
@@ -66,6 +73,36 @@ class BaseHandler(tornado.web.RequestHandler):
         '''
         return self.application.client
 
+    @property
+    def trainer(self):
+        '''Instance getter for the background training queue
+        '''
+        return self.application.trainer
+
+    @property
+    def loader(self):
+        '''Instance getter for the model loader (fills self.models)
+        '''
+        return self.application.loader
+
+    @property
+    def predictions(self):
+        '''Instance getter for the cache of recent predictions
+        '''
+        return self.application.predictions
+
+    @property
+    def features(self):
+        '''Instance getter for the feature recompute queue
+        '''
+        return self.application.features
+
+    @property
+    def batcher(self):
+        '''Instance getter for the prediction micro-batcher
+        '''
+        return self.application.batcher
+
     @property
     def clf(self):
         '''Instance getter for current classifier
@@ -112,6 +149,32 @@ class BaseHandler(tornado.web.RequestHandler):
             e = "%s could not be read as a long integer" % value
             raise HTTPJSONError(1, e)
 
+    def get_signal_data(self, fields):
+        '''Read an audio request body into a dict. JSON bodies are parsed
+           as-is. Raw PCM (application/octet-stream, sample format from the
+           "format" argument: float32 or int16) and WAV (audio/wav) bodies go
+           straight into a numpy array under 'signal'; the other fields come
+           from query arguments or X-<Field-Name> headers.
+           Raises ValueError (or KeyError) on a malformed body
+        '''
+        content_type = self.request.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type not in WAV_CONTENT_TYPES + PCM_CONTENT_TYPES:
+            return json.loads(self.request.body.decode("utf-8"))
+
+        data = {}
+        for field in fields:
+            header = "X-" + field.replace("_", "-").title()
+            value = self.get_argument(field, self.request.headers.get(header))
+            if value is not None:
+                data[field] = value
+
+        if content_type in WAV_CONTENT_TYPES:
+            data['sample_rate'], data['signal'] = decode_wav(self.request.body)
+        else:
+            sample_format = self.get_argument("format", self.request.headers.get("X-Format", "float32"))
+            data['signal'] = decode_pcm(self.request.body, sample_format)
+        return data
+
     def write_json(self, value={}):
         '''Completes header and writes JSONified 
            HTTP back to client
@@ -127,3 +190,12 @@ class BaseHandler(tornado.web.RequestHandler):
     #pass the models we store in memory to each of the handlers
     def initialize(self, models):
      self.models = models
+     self.timer = StageTimer() # handlers time their stages with this
+     self.dsid = None # set by handlers working on one dataset, for the metrics labels
+     self.started = time.perf_counter()
+
+    def on_finish(self):
+        '''Record the stage timings of this request'''
+        endpoint, total = type(self).__name__, self.request.request_time()
+        self.application.metrics.observe_request(endpoint, self.timer.stages, total, self.dsid)
+        self.application.profiler.finish(endpoint, self.dsid, self.started, self.timer.stages, total)
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+'''Coalescing concurrent predictions into one vectorized pass'''
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from metrics import StageTimer
+
+
+class MicroBatcher():
+    '''Gathers predictions that arrive within window seconds of each other
+       for the same key (dsid, clf_name, sample_rate, version) and runs them
+       as one call of predict_fn(clf, signals, sample_rate, timer) in a
+       thread. The version keeps requests holding a retrained model out of
+       a batch still open for the old one. A batch is flushed early once it
+       holds max_batch signals. The stages predict_fn times are added to
+       the timer of every request in the batch
+    '''
+    def __init__(self, predict_fn, window=0.002, max_batch=32, executor=None):
+        self.predict_fn = predict_fn
+        self.window = window
+        self.max_batch = max_batch
+        self.executor = executor # None is the IOLoop's default pool
+        self.pending = {} # key -> (clf, [signals], [futures], [timers], timeout handle)
+        self.batches = 0
+        self.predictions = 0
+
+    def predict(self, key, clf, signal, timer=None):
+        '''Future resolving to the label predicted for signal'''
+        future = Future()
+        if key not in self.pending:
+            handle = IOLoop.current().call_later(self.window, self._flush, key)
+            self.pending[key] = (clf, [], [], [], handle)
+        batch = self.pending[key]
+        batch[1].append(signal)
+        batch[2].append(future)
+        batch[3].append(timer)
+        if len(batch[1]) >= self.max_batch:
+            IOLoop.current().remove_timeout(batch[4])
+            self._flush(key)
+        return future
+
+    def _flush(self, key):
+        clf, signals, futures, timers, handle = self.pending.pop(key)
+        self.batches += 1
+        self.predictions += len(signals)
+        IOLoop.current().spawn_callback(self._run, key, clf, signals, futures, timers)
+
+    async def _run(self, key, clf, signals, futures, timers):
+        dsid, clf_name, sample_rate, version = key
+        batch_timer = StageTimer()
+        try:
+            labels = await IOLoop.current().run_in_executor(self.executor, self.predict_fn, clf, signals, sample_rate, batch_timer)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for timer in timers:
+            if timer is not None:
+                for stage, seconds in batch_timer.stages.items():
+                    timer.add(stage, seconds)
+        for future, label in zip(futures, labels):
+            future.set_result(label)
+
+    def stats(self):
+        return {"batches": self.batches,
+                "predictions": self.predictions}
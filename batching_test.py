@@ -0,0 +1,18 @@
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from batching import MicroBatcher
+
+
+def test_retrained_model_gets_its_own_batch():
+    # predict_fn answers with the name of the model it was handed
+    batcher = MicroBatcher(lambda clf, signals, sample_rate, timer: [clf] * len(signals), window=0.05)
+
+    async def run():
+        old = batcher.predict((1, "knn", 8000, 1), "v1", [0.0])
+        new = batcher.predict((1, "knn", 8000, 2), "v2", [0.0]) # a retrain landed in the window
+        again = batcher.predict((1, "knn", 8000, 2), "v2", [0.0])
+        return await gen.multi([old, new, again])
+
+    assert IOLoop.current().run_sync(run) == ["v1", "v2", "v2"]
+    assert batcher.stats() == {"batches": 2, "predictions": 3}
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+'''Recall vs latency of the knn backends against the exact classifier
+
+Features are real MFCCs of synthetic clips (8 kHz, 3.5 s, 4176 values),
+each class a different set of tones with random onsets over noise.
+
+    python benchmarks/knn_backends.py [--sizes 1000 4000] [--queries 200]
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+
+from audioutility import batch_mfcc
+from knnbackends import make_knn
+
+SAMPLE_RATE = 8000
+BACKENDS = [
+    {"backend": "exact"},
+    {"backend": "pca", "n_components": 16},
+    {"backend": "pca", "n_components": 64},
+    {"backend": "lsh", "n_bits": 6, "n_tables": 16},
+    {"backend": "lsh", "n_bits": 8, "n_tables": 24},
+]
+
+
+def make_dataset(n, n_classes, rng):
+    tones = rng.uniform(150, 3000, size=(n_classes, 3))
+    t = np.arange(int(SAMPLE_RATE * 3.6)) / float(SAMPLE_RATE)
+    labels = rng.integers(n_classes, size=n)
+    clips = np.empty((n, t.size), dtype=np.float32)
+    for i, label in enumerate(labels):
+        clip = 0.05 * rng.normal(size=t.size)
+        for freq in tones[label] * rng.uniform(0.97, 1.03, size=3):
+            onset = rng.uniform(0, 2.5)
+            clip += 0.3 * np.sin(2 * np.pi * freq * t) * ((t > onset) & (t < onset + 1))
+        clips[i] = clip * 10000
+    return batch_mfcc(clips, SAMPLE_RATE, dtype=np.float32).reshape(n, -1), labels
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    res = fn(*args)
+    return res, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 4000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--classes", type=int, default=8)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for n in args.sizes:
+        f, l = make_dataset(n + args.queries, args.classes, rng)
+        f_train, l_train, f_test, l_test = f[:n], l[:n], f[n:], l[n:]
+
+        exact = make_knn(n_neighbors=args.k, algorithm='brute').fit(f_train, l_train)
+        truth = exact.kneighbors(f_test, return_distance=False)
+        for params in BACKENDS:
+            clf, fit_s = timed(make_knn(n_neighbors=args.k, **params).fit, f_train, l_train)
+            ind = clf.kneighbors(f_test)[1] if params["backend"] != "exact" else truth
+            recall = np.mean([len(set(a) & set(b)) / float(args.k) for a, b in zip(ind, truth)])
+            pred, batch_s = timed(clf.predict, f_test)
+            single = [timed(clf.predict, f_test[i:i + 1])[1] for i in range(min(50, args.queries))]
+            print(json.dumps({"n": n, "params": params,
+                              "recall_at_k": round(float(recall), 3),
+                              "accuracy": round(float(np.mean(pred == l_test)), 3),
+                              "fit_s": round(fit_s, 3),
+                              "batch_ms_per_query": round(1000 * batch_s / len(f_test), 3),
+                              "single_query_ms": round(1000 * float(np.median(single)), 3)}))
+
+if __name__ == "__main__":
+    main()
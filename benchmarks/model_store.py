@@ -0,0 +1,72 @@
+#!/usr/bin/python
+'''Saving and loading a fitted KNN: pickled into the models document
+versus the GridFS model store with memory-mapped loads
+
+Runs against mongomock, so database round-trips are not included:
+
+    python benchmarks/model_store.py [--sizes 1000 4000] [--dims 4176]
+'''
+
+import argparse
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bson
+from bson.binary import Binary
+import mongomock
+import mongomock.gridfs
+import numpy as np
+from sklearn.neighbors import KNeighborsClassifier
+
+from modelcache import estimate_size
+from modelstore import ModelStore
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    res = fn(*args)
+    return res, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 4000])
+    parser.add_argument("--dims", type=int, default=4176, help="values per feature")
+    parser.add_argument("--compress", type=int, default=0)
+    args = parser.parse_args()
+
+    mongomock.gridfs.enable_gridfs_integration()
+    rng = np.random.default_rng(0)
+    for n in args.sizes:
+        knn = KNeighborsClassifier(n_neighbors=3).fit(rng.normal(size=(n, args.dims)).astype(np.float32), np.arange(n) % 4)
+
+        # before: one pickle in a Binary field of the models document
+        doc, pickle_save = timed(lambda: bson.BSON.encode({"dsid": 1, "knn_model": Binary(pickle.dumps(knn))}))
+        models, pickle_load = timed(lambda: pickle.loads(bson.BSON(doc).decode()["knn_model"]))
+
+        store = ModelStore(mongomock.MongoClient().db, tempfile.mkdtemp(), args.compress)
+        files, store_save = timed(store.save, 1, 1, {"knn": knn})
+        stored = dict(files, dsid=1, version=1)
+        os.remove(store.fetch(stored, "knn")) # cold: download from GridFS first
+        models, store_cold = timed(store.load, stored)
+        models, store_warm = timed(store.load, stored)
+
+        print(json.dumps({"n": n,
+                          "document_bytes": len(doc),
+                          "fits_in_document": len(doc) < 16 * 1024 * 1024,
+                          "stored_document_bytes": len(bson.BSON.encode(stored)),
+                          "pickle_save_ms": round(1000 * pickle_save, 1),
+                          "pickle_load_ms": round(1000 * pickle_load, 1),
+                          "store_save_ms": round(1000 * store_save, 1),
+                          "store_cold_load_ms": round(1000 * store_cold, 1),
+                          "store_load_ms": round(1000 * store_warm, 1),
+                          "heap_bytes_after_load": estimate_size(models)}))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+'''Latency and throughput of PredictOne with and without micro-batching,
+and of the same clips sent through one PredictBatch request.
+
+Runs the whole server in-process against mongomock:
+
+    python benchmarks/predict_batching.py [--clients 32] [--requests 256]
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mongomock
+import mongomock.gridfs
+import numpy as np
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.options import options
+from tornado.testing import bind_unused_port
+
+from tornado_scikit_learn import Application
+
+SAMPLE_RATE = 16000
+
+
+def clip(rng, freq):
+    t = np.arange(int(SAMPLE_RATE * 3.6)) / float(SAMPLE_RATE)
+    return (0.3 * np.sin(2 * np.pi * freq * t * (1 + t)) + 0.01 * rng.normal(size=t.size)).astype(np.float32)
+
+
+async def run(args, window_ms, max_batch):
+    options.train_executor = "thread"
+    mongomock.gridfs.enable_gridfs_integration()
+    options.batch_window_ms = window_ms
+    options.max_batch = max_batch
+    app = Application(client=mongomock.MongoClient())
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    url = "http://127.0.0.1:%d" % port
+    client = AsyncHTTPClient(max_clients=args.clients)
+
+    res = await client.fetch(url + "/Login", method="POST", body=json.dumps({"username": "user", "password": "pass"}))
+    headers = {"Cookie": res.headers["Set-Cookie"].split(";")[0]}
+
+    rng = np.random.default_rng(0)
+    for i in range(args.train):
+        label, freq = ("low", 200) if i % 2 else ("high", 1500)
+        await client.fetch(url + "/AddDataPoint?sample_rate=%d&label=%s&dsid=1" % (SAMPLE_RATE, label), method="POST",
+                           body=clip(rng, freq + i).tobytes(), headers=dict(headers, **{"Content-Type": "application/octet-stream"}))
+    await client.fetch(url + "/UpdateModel", method="POST", headers=headers,
+                       body=json.dumps({"dsid": 1, "knn": {"n_neighbors": 3}, "svm": {}, "wait": True}))
+
+    bodies = [clip(rng, 200 if i % 2 else 1500).tobytes() for i in range(args.requests)]
+    binary = dict(headers, **{"Content-Type": "application/octet-stream"})
+    path = url + "/PredictOne?sample_rate=%d&dsid=1&clf_name=%s" % (SAMPLE_RATE, args.clf)
+    await client.fetch(path, method="POST", body=bodies[0], headers=binary) # warm the model cache
+
+    latencies = []
+    async def one(body):
+        start = time.perf_counter()
+        await client.fetch(path, method="POST", body=body, headers=binary)
+        latencies.append(time.perf_counter() - start)
+
+    async def worker(queue):
+        while queue:
+            await one(queue.pop())
+
+    queue = list(bodies)
+    start = time.perf_counter()
+    await gen.multi([worker(queue) for _ in range(args.clients)])
+    elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await client.fetch(url + "/PredictBatch?sample_rate=%d&dsid=1&clf_name=%s&count=%d" % (SAMPLE_RATE, args.clf, len(bodies)),
+                       method="POST", body=b"".join(bodies), headers=binary, request_timeout=600)
+    batch_elapsed = time.perf_counter() - start
+
+    server.stop()
+    ms = np.array(latencies) * 1000
+    return {"window_ms": window_ms,
+            "max_batch": max_batch,
+            "requests_per_s": round(len(bodies) / elapsed, 1),
+            "p50_ms": round(float(np.percentile(ms, 50)), 2),
+            "p95_ms": round(float(np.percentile(ms, 95)), 2),
+            "p99_ms": round(float(np.percentile(ms, 99)), 2),
+            "mean_batch": round(app.batcher.predictions / float(max(app.batcher.batches, 1)), 1),
+            "predict_batch_clips_per_s": round(len(bodies) / batch_elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--clients", type=int, default=32, help="concurrent PredictOne clients")
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--train", type=int, default=200, help="training clips")
+    parser.add_argument("--clf", default="knn")
+    args = parser.parse_args()
+
+    for window_ms, max_batch in ((0.0, 1), (2.0, 32), (5.0, 64)):
+        print(json.dumps(IOLoop.current().run_sync(lambda: run(args, window_ms, max_batch))))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/python
+'''Benchmark suite for the feature pipeline, the classifiers and the HTTP
+endpoints, with results saved as JSON to compare runs against each other
+
+    python benchmarks/suite.py [--only mfcc json models http] [--quick]
+                               [--out results.json] [--compare baseline.json]
+
+Sections:
+  mfcc    get_filter_mfcc (float64 and float32) and batch_mfcc per clip,
+          at several sample rates and clip lengths
+  json    decoding a signal payload: JSON list vs raw float32 body
+  models  fit and predict of knn and svm at growing dataset sizes
+  http    /AddDataPoint, /UpdateModel and /PredictOne (new and repeated
+          clips) latency percentiles and throughput, whole server
+          in-process against mongomock
+
+--compare lists every *_ms metric that got slower and every *_per_s
+metric that dropped by more than --tolerance, and exits 1 if any did.
+Tail percentiles are recorded but not compared, they are too noisy
+over this few repeats.
+'''
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+
+from audioutility import AudioUtility, batch_mfcc, decode_pcm
+
+
+def percentiles(seconds):
+    '''median/p95/p99 in ms of a list of durations in seconds'''
+    ms = np.array(seconds) * 1000
+    return {"p50_ms": round(float(np.percentile(ms, 50)), 3),
+            "p95_ms": round(float(np.percentile(ms, 95)), 3),
+            "p99_ms": round(float(np.percentile(ms, 99)), 3)}
+
+def measure(fn, repeat):
+    '''Run fn repeat times (after one warm-up call), returns its percentiles'''
+    fn()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return percentiles(seconds)
+
+def clip(rng, sample_rate, seconds):
+    t = np.arange(int(sample_rate * seconds)) / float(sample_rate)
+    return (0.3 * np.sin(2 * np.pi * 440 * t * (1 + t)) + 0.01 * rng.normal(size=t.size)).astype(np.float32)
+
+
+def bench_mfcc(args, rng):
+    res = {}
+    for sample_rate in (8000, 16000, 44100):
+        for seconds in (3.5, 5.0, 10.0):
+            signal = clip(rng, sample_rate, seconds) * 10000
+            au = AudioUtility(signal=signal, sample_rate=sample_rate)
+            clips = np.stack([signal] * 32)
+            batch = measure(lambda: batch_mfcc(clips, sample_rate, subsample_length=seconds, dtype=np.float32), max(args.repeat // 10, 3))
+            res["%dHz_%gs" % (sample_rate, seconds)] = {
+                "float64": measure(lambda: au.get_filter_mfcc(subsample_length=seconds), args.repeat),
+                "float32": measure(lambda: au.get_filter_mfcc(subsample_length=seconds, dtype=np.float32), args.repeat),
+                "batch32_per_clip_ms": round(batch["p50_ms"] / len(clips), 3),
+            }
+    return res
+
+def bench_json(args, rng):
+    res = {}
+    for sample_rate in (8000, 16000, 44100):
+        signal = clip(rng, sample_rate, 3.6)
+        body = json.dumps({"signal": signal.tolist(), "sample_rate": sample_rate, "dsid": 1, "label": "x"}).encode("utf-8")
+        raw = signal.tobytes()
+        res["%dHz" % sample_rate] = {
+            "json_bytes": len(body),
+            "json": measure(lambda: np.asarray(json.loads(body.decode("utf-8"))["signal"], dtype=np.float32), args.repeat),
+            "float32_bytes": len(raw),
+            "float32": measure(lambda: decode_pcm(raw, "float32"), args.repeat),
+        }
+    return res
+
+def bench_models(args, rng):
+    from training import CLASSIFIERS
+    res = {}
+    dims = 349 * 12 # mfcc of a 3.5s clip
+    for n in args.sizes:
+        centers = rng.normal(size=(4, dims)).astype(np.float32)
+        labels = np.arange(n) % 4
+        f = centers[labels] + rng.normal(scale=2.0, size=(n, dims)).astype(np.float32)
+        for key, params in (("knn", {"n_neighbors": 3}), ("svm", {})):
+            start = time.perf_counter()
+            clf = CLASSIFIERS[key](**params).fit(f, labels)
+            fit_s = time.perf_counter() - start
+            res["%s_%d" % (key, n)] = {
+                "fit_ms": round(1000 * fit_s, 1),
+                "predict_one": measure(lambda: clf.predict(f[:1]), args.repeat),
+                "predict_32_per_clip_ms": round(measure(lambda: clf.predict(f[:32]), max(args.repeat // 10, 3))["p50_ms"] / 32, 3),
+            }
+    return res
+
+def bench_http(args, rng):
+    import mongomock
+    import mongomock.gridfs
+    import tempfile
+    from tornado.httpclient import AsyncHTTPClient
+    from tornado.httpserver import HTTPServer
+    from tornado.ioloop import IOLoop
+    from tornado.options import options
+    from tornado.testing import bind_unused_port
+    from tornado_scikit_learn import Application
+
+    sample_rate = 16000
+    mongomock.gridfs.enable_gridfs_integration()
+    options.train_executor = "thread"
+    options.model_dir = tempfile.mkdtemp()
+
+    async def run():
+        app = Application(client=mongomock.MongoClient())
+        sock, port = bind_unused_port()
+        server = HTTPServer(app)
+        server.add_sockets([sock])
+        url = "http://127.0.0.1:%d" % port
+        client = AsyncHTTPClient()
+        res = await client.fetch(url + "/Login", method="POST", body=json.dumps({"username": "user", "password": "pass"}))
+        headers = {"Cookie": res.headers["Set-Cookie"].split(";")[0]}
+        binary = dict(headers, **{"Content-Type": "application/octet-stream"})
+
+        async def timed(path, body, headers):
+            start = time.perf_counter()
+            await client.fetch(url + path, method="POST", body=body, headers=headers, request_timeout=600)
+            return time.perf_counter() - start
+
+        out = {}
+        for name, encode, hdrs in (("json", lambda s, label: json.dumps({"signal": s.tolist(), "sample_rate": sample_rate, "label": label, "dsid": 1}), headers),
+                                   ("float32", lambda s, label: s.tobytes(), binary)):
+            seconds = []
+            for i in range(args.requests):
+                label = "low" if i % 2 else "high"
+                path = "/AddDataPoint" if name == "json" else "/AddDataPoint?sample_rate=%d&label=%s&dsid=1" % (sample_rate, label)
+                seconds.append(await timed(path, encode(clip(rng, sample_rate, 3.6) * (1 + i % 2), label), hdrs))
+            out["add_datapoint_" + name] = dict(percentiles(seconds), requests_per_s=round(len(seconds) / sum(seconds), 1))
+
+        seconds = []
+        for _ in range(3):
+            body = json.dumps({"dsid": 1, "knn": {"n_neighbors": 3}, "svm": {}, "wait": True})
+            seconds.append(await timed("/UpdateModel", body, headers))
+        out["update_model"] = dict(percentiles(seconds), instances=2 * args.requests)
+
+        path = "/PredictOne?sample_rate=%d&dsid=1&clf_name=knn" % sample_rate
+        bodies = [clip(rng, sample_rate, 3.6).tobytes() for _ in range(args.requests)]
+        await timed(path, bodies[0], binary) # warm the model cache
+        seconds = [await timed(path, body, binary) for body in bodies]
+        out["predict_one"] = dict(percentiles(seconds), requests_per_s=round(len(seconds) / sum(seconds), 1))
+        # the same clip again, answered from the prediction cache
+        seconds = [await timed(path, bodies[0], binary) for _ in bodies]
+        out["predict_one_repeated"] = dict(percentiles(seconds), requests_per_s=round(len(seconds) / sum(seconds), 1))
+        server.stop()
+        return out
+
+    return IOLoop.current().run_sync(run)
+
+SECTIONS = {
+    "mfcc": bench_mfcc,
+    "json": bench_json,
+    "models": bench_models,
+    "http": bench_http,
+}
+
+
+def flatten(results, prefix=""):
+    '''{"section/case/metric": value} of the numeric leaves'''
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "/"))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+def compare(results, baseline, tolerance):
+    '''Lines describing metrics that regressed by more than tolerance'''
+    new, old = flatten(results), flatten(baseline)
+    regressions = []
+    for key in sorted(set(new) & set(old)):
+        if not old[key] or key.endswith(("p95_ms", "p99_ms")):
+            continue
+        ratio = new[key] / float(old[key])
+        if (key.endswith("_ms") and ratio > 1 + tolerance) or (key.endswith("_per_s") and ratio < 1 - tolerance):
+            regressions.append("%-60s %10.3f -> %10.3f (%+.0f%%)" % (key, old[key], new[key], 100 * (ratio - 1)))
+    return regressions
+
+def metadata():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    import sklearn
+    return {"time": datetime.datetime.now().isoformat(),
+            "commit": commit,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "sklearn": sklearn.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--only", nargs="+", choices=sorted(SECTIONS), default=sorted(SECTIONS))
+    parser.add_argument("--quick", action="store_true", help="fewer repeats and smaller datasets")
+    parser.add_argument("--sizes", type=int, nargs="+", default=None, help="dataset sizes for the models section")
+    parser.add_argument("--out", default=None, help="write the results here (default: print them)")
+    parser.add_argument("--compare", default=None, help="results file of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative change counted as a regression")
+    args = parser.parse_args()
+    args.repeat = 10 if args.quick else 50
+    args.requests = 20 if args.quick else 100
+    if args.sizes is None:
+        args.sizes = [100, 500] if args.quick else [100, 500, 2000]
+
+    rng = np.random.default_rng(0)
+    results = {"meta": metadata()}
+    for name in args.only:
+        print("running %s" % name, file=sys.stderr)
+        results[name] = SECTIONS[name](args, rng)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=1, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        baseline.pop("meta", None)
+        regressions = compare({k: v for k, v in results.items() if k != "meta"}, baseline, args.tolerance)
+        for line in regressions:
+            print("slower: " + line, file=sys.stderr)
+        print("%d regressions against %s" % (len(regressions), args.compare), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
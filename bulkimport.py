@@ -0,0 +1,166 @@
+#!/usr/bin/python
+'''Importing many labeled WAV clips into a dataset at once
+
+POST /ImportDataset takes a tar (optionally compressed) or a
+multipart/form-data upload, and a directory can be imported directly:
+
+    python bulkimport.py data/ --dsid 3 [--label speech] [--split 3.5]
+
+A clip's label is, in order: its entry in a labels.csv (filename,label)
+next to it, its parent directory in a tar or directory (low/a.wav), the
+label argument, or its form field name in a multipart upload. Clips are
+featurized in batches on a worker pool, the same way AddDataPoint does
+it, and written with insert_many while the next batches are computed.
+'''
+
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import csv
+from functools import partial
+import io
+import os
+import tarfile
+import time
+
+from pymongo import MongoClient
+from tornado.ioloop import IOLoop
+import numpy as np
+
+from asyncdb import AsyncDatabase
+from audioutility import batch_mfcc, decode_wav
+from dataset import encode_audio, encode_feature, ensure_indexes
+
+# clips per worker task and per insert_many
+IMPORT_BATCH_SIZE = 64
+
+# AddDataPoint featurizes in float32 too, see sklearnhandlers.MFCC_DTYPE
+IMPORT_DTYPE = np.float32
+
+def read_labels(buf):
+    '''{filename: label} from labels.csv bytes'''
+    rows = csv.reader(io.StringIO(buf.decode("utf-8")))
+    return {os.path.basename(row[0].strip()): row[1].strip() for row in rows if len(row) >= 2}
+
+def label_clips(files, default_label=None):
+    '''[(name, label, wav bytes)] from (path, bytes, fallback label) entries,
+       labels.csv entries are read and not imported. default_label, when
+       given, wins over the fallbacks (form field names)
+    '''
+    files = list(files)
+    labels = {}
+    for path, buf, fallback in files:
+        if os.path.basename(path) == 'labels.csv':
+            labels.update(read_labels(buf))
+
+    clips = []
+    for path, buf, fallback in files:
+        name = os.path.basename(path)
+        if not name.lower().endswith('.wav'):
+            continue
+        directory = os.path.basename(os.path.dirname(path))
+        clips.append((path, labels.get(name) or directory or default_label or fallback, buf))
+    return clips
+
+def tar_files(buf):
+    '''(path, bytes, None) for each file in a tar, any compression'''
+    with tarfile.open(fileobj=io.BytesIO(buf), mode='r:*') as tar:
+        for member in tar:
+            if member.isfile():
+                yield member.name, tar.extractfile(member).read(), None
+
+def directory_files(root):
+    '''(path relative to root, bytes, None) for each file under root'''
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as f:
+                yield os.path.relpath(path, root), f.read(), None
+
+def featurize_clips(clips, dsid, binary=False, store_audio=True, split=None, subsample_length=3.5):
+    '''labeledinstances documents for a batch of (name, label, wav bytes)
+       clips (runs inside the pool). With split, every split seconds of a
+       recording is an instance of its own. Returns (docs, failed names)
+    '''
+    docs, failed = [], []
+    by_rate = {} # sample_rate -> [(label, signal)]
+    for name, label, buf in clips:
+        try:
+            if label is None:
+                raise ValueError("no label")
+            sample_rate, signal = decode_wav(buf)
+            step = int((split or len(signal) / float(sample_rate)) * sample_rate)
+            segments = [signal[start:start + step] for start in range(0, len(signal), max(step, 1))]
+            segments = [s for s in segments if len(s) >= int(subsample_length * sample_rate)]
+            if not segments:
+                raise ValueError("not long enough")
+        except Exception:
+            failed.append(name)
+            continue
+        by_rate.setdefault(sample_rate, []).extend((label, s) for s in segments)
+
+    for sample_rate, segments in by_rate.items():
+        #preprocess the audio, since we are only training the ML model on the mfcc transformation
+        mfcc = batch_mfcc([s * 10000 for label, s in segments], sample_rate, subsample_length=subsample_length, dtype=IMPORT_DTYPE)
+        for (label, signal), m in zip(segments, mfcc):
+            doc = encode_feature(m, binary=binary)
+            if store_audio:
+                doc.update(encode_audio(signal, sample_rate))
+            doc.update({"label": str(label), "dsid": dsid})
+            docs.append(doc)
+    return docs, failed
+
+async def import_clips(db, clips, dsid, executor, batch=IMPORT_BATCH_SIZE, **kwargs):
+    '''Featurize clips in the pool and insert them into db.labeledinstances
+       (an AsyncDatabase), keeping every worker busy while inserting.
+       kwargs go to featurize_clips. Returns a summary for the client
+    '''
+    start = time.perf_counter()
+    loop = IOLoop.current()
+    batches = deque(clips[i:i + batch] for i in range(0, len(clips), batch))
+    in_flight = deque()
+    workers = getattr(executor, '_max_workers', 1)
+    instances, failed = 0, []
+    while batches or in_flight:
+        while batches and len(in_flight) < 2 * workers:
+            in_flight.append(loop.run_in_executor(executor, partial(featurize_clips, batches.popleft(), dsid, **kwargs)))
+        docs, bad = await in_flight.popleft()
+        if docs:
+            await db.labeledinstances.insert_many(docs, ordered=False)
+        instances += len(docs)
+        failed.extend(bad)
+
+    seconds = time.perf_counter() - start
+    return {"dsid": dsid,
+            "clips": len(clips) - len(failed),
+            "instances": instances,
+            "failed": failed,
+            "seconds": round(seconds, 3),
+            "clips_per_s": round((len(clips) - len(failed)) / seconds, 1) if seconds else None}
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a directory of labeled WAV clips into a dataset")
+    parser.add_argument("directory")
+    parser.add_argument("--dsid", type=int, required=True)
+    parser.add_argument("--label", default=None, help="label of clips with no other label")
+    parser.add_argument("--split", type=float, default=None, help="cut recordings into clips of this many seconds")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--binary_features", action="store_true")
+    parser.add_argument("--no_audio", action="store_true", help="do not keep the audio of the clips")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=27017)
+    args = parser.parse_args()
+
+    client = MongoClient(args.host, args.port)
+    ensure_indexes(client.sklearndatabase)
+    db = AsyncDatabase(client.sklearndatabase, ThreadPoolExecutor(2))
+    clips = label_clips(directory_files(args.directory), args.label)
+    with ProcessPoolExecutor(args.workers) as executor:
+        res = IOLoop.current().run_sync(lambda: import_clips(db, clips, args.dsid, executor,
+                                                             binary=args.binary_features, store_audio=not args.no_audio, split=args.split))
+    print("imported %(instances)d instances from %(clips)d clips into dsid %(dsid)d in %(seconds).1fs (%(clips_per_s)s clips/s)" % res)
+    if res["failed"]:
+        print("could not import: %s" % ", ".join(res["failed"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+'''Storing and reading labeled instances in mongo
+
+These are blocking helpers over a pymongo collection, run them off the
+IOLoop with AsyncCollection.run. Run as a script for maintenance:
+
+    python dataset.py migrate [--dsid N]
+'''
+
+import argparse
+
+from bson.binary import Binary
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+import numpy as np
+
+# documents per round-trip when streaming a dataset out of labeledinstances
+LOAD_BATCH_SIZE = 1000
+
+# dtype of binary features, little-endian so the blobs mean the same everywhere
+FEATURE_DTYPE = '<f4'
+
+# A feature is stored either as a BSON array of floats (the original format)
+# or, opt-in, as one float32 blob: {"feature": Binary, "feature_shape": [frames, ceps],
+# "feature_dtype": "<f4"} which is ~4 bytes a value and decodes with frombuffer
+def encode_feature(mfcc, binary=False):
+    '''Fields to store for an mfcc in labeledinstances'''
+    if not binary:
+        return {"feature": np.ravel(mfcc).tolist()} # plain python floats for BSON
+    arr = np.ascontiguousarray(mfcc, dtype=FEATURE_DTYPE)
+    return {"feature": Binary(arr.tobytes()),
+            "feature_shape": list(arr.shape),
+            "feature_dtype": FEATURE_DTYPE}
+
+def decode_feature(doc):
+    '''Flat feature vector of a labeledinstances document, either format'''
+    feature = doc['feature']
+    if isinstance(feature, bytes):
+        return np.frombuffer(feature, dtype=doc.get('feature_dtype', FEATURE_DTYPE))
+    return feature
+
+# The signal a feature was computed from is kept as {"audio": Binary int16,
+# "audio_scale": float, "sample_rate": int}, 2 bytes a sample, so features
+# can be recomputed with other MFCC parameters (see features.py). The scale
+# maps the loudest sample to full scale, any range the clients send survives
+def encode_audio(signal, sample_rate):
+    '''Fields to store for a raw signal in labeledinstances'''
+    signal = np.asarray(signal, dtype=np.float32)
+    peak = float(np.max(np.abs(signal))) if len(signal) else 0.0
+    scale = peak / 32767 if peak > 0 else 1.0
+    pcm = np.round(signal / scale).astype('<i2')
+    return {"audio": Binary(pcm.tobytes()),
+            "audio_scale": scale,
+            "sample_rate": int(sample_rate)}
+
+def decode_audio(doc):
+    '''float32 signal of a labeledinstances document stored with encode_audio'''
+    return np.frombuffer(doc['audio'], dtype='<i2') * np.float32(doc['audio_scale'])
+
+def ensure_indexes(db):
+    '''Indexes the handlers rely on, safe to call on every startup'''
+    db.labeledinstances.create_index("dsid")
+    db.models.create_index("dsid")
+    db.features.create_index([("dsid", 1), ("params", 1)])
+    db.features.create_index([("instance", 1), ("params", 1)], unique=True)
+
+def next_dsid(counters):
+    '''Allocate a new dataset id from the "dsid" document of the counters
+       collection, one atomic $inc so concurrent callers (and workers)
+       never get the same id. Clients may also pick dsids themselves
+       (AddDataPoint, ImportDataset), so an id that already holds instances
+       or models is skipped and the counter jumps past the highest dsid
+    '''
+    db = counters.database
+    while True:
+        counter = counters.find_one_and_update({"_id": "dsid"}, {"$inc": {"seq": 1}},
+                                               return_document=ReturnDocument.AFTER)
+        if counter is None:
+            # first allocation, start after the dsids already in use
+            try:
+                counters.update_one({"_id": "dsid"}, {"$max": {"seq": highest_dsid(db)}}, upsert=True)
+            except DuplicateKeyError:
+                pass # another caller created it first
+            continue
+        dsid = int(counter["seq"])
+        if not any(collection.find_one({"dsid": dsid}, {"_id": 1}) for collection in (db.labeledinstances, db.models)):
+            return dsid
+        # $max, so racing callers can only ever raise the counter
+        counters.update_one({"_id": "dsid"}, {"$max": {"seq": highest_dsid(db)}})
+
+def highest_dsid(db):
+    '''Highest dsid in labeledinstances or models, 0 if there are none'''
+    highest = 0
+    for collection in (db.labeledinstances, db.models):
+        doc = collection.find_one({}, {"dsid": 1}, sort=[("dsid", -1)])
+        if doc is not None:
+            highest = max(highest, int(doc["dsid"]))
+    return highest
+
+def load_instances(collection, query, dtype=np.float64):
+    '''Features, labels and _ids of the instances matching query'''
+    n = collection.count_documents(query)
+    cursor = collection.find(query, {"feature": 1, "feature_dtype": 1, "label": 1}).batch_size(LOAD_BATCH_SIZE)
+
+    f, l, ids = None, [], []
+    for i, a in enumerate(cursor):
+        feature = decode_feature(a)
+        if f is None:
+            f = np.empty((max(n, 1), len(feature)), dtype=dtype)
+        elif i == len(f):
+            # instances were added since we counted
+            f = np.concatenate((f, np.empty_like(f)))
+        f[i] = feature
+        l.append(a['label'])
+        ids.append(a['_id'])
+
+    if f is None:
+        return np.empty((0, 0), dtype=dtype), np.array(l), ids
+    return f[:len(l)], np.array(l), ids
+
+def mark_fitted(collection, ids, batch=LOAD_BATCH_SIZE):
+    '''Flag instances as included in the stored models of their dataset,
+       incremental retrains only load instances without the flag
+    '''
+    for start in range(0, len(ids), batch):
+        collection.update_many({"_id": {"$in": ids[start:start + batch]}}, {"$set": {"fitted": True}})
+
+def migrate_features(collection, dsid=None, batch=LOAD_BATCH_SIZE):
+    '''Rewrite array features as binary ones, returns how many changed'''
+    query = {"feature": {"$type": "array"}}
+    if dsid is not None:
+        query["dsid"] = dsid
+
+    changed, ops = 0, []
+    for a in collection.find(query, {"feature": 1}).batch_size(batch):
+        # the old format does not record the mfcc shape, keep it flat
+        ops.append(UpdateOne({"_id": a["_id"]}, {"$set": encode_feature(a["feature"], binary=True)}))
+        if len(ops) == batch:
+            changed += collection.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        changed += collection.bulk_write(ops, ordered=False).modified_count
+    return changed
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance for the labeledinstances collection")
+    parser.add_argument("command", choices=["migrate"], help="migrate: store array features as float32 blobs")
+    parser.add_argument("--dsid", type=int, default=None, help="only this dataset")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=27017)
+    args = parser.parse_args()
+
+    db = MongoClient(args.host, args.port).sklearndatabase
+    if args.command == "migrate":
+        print("migrated %d instances" % migrate_features(db.labeledinstances, args.dsid))
+
+if __name__ == "__main__":
+    main()
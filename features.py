@@ -0,0 +1,182 @@
+#!/usr/bin/python
+'''Features for MFCC parameters other than the defaults
+
+labeledinstances holds the features AddDataPoint computes with the
+default parameters, plus the raw audio they came from. Features for any
+other parameters are cached in db.features, one document per instance
+and parameter set:
+
+    {"instance": ObjectId, "dsid": 3, "params": "<mfcc_key>", "label": "low",
+     "feature": Binary, "feature_shape": [...], "feature_dtype": "<f4"}
+
+and filled in bulk from the stored audio by FeatureQueue, so changing
+nfilt, num_ceps or subsample_length does not need the clients to resend
+anything. UpdateModel takes the parameters as "mfcc": {...}.
+'''
+
+import hashlib
+import json
+import time
+import uuid
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+import numpy as np
+
+from audioutility import batch_mfcc
+from dataset import LOAD_BATCH_SIZE, decode_audio, encode_feature
+from jobs import JobBoard
+
+# keyword arguments of get_filter_mfcc / batch_mfcc that change the features
+MFCC_DEFAULTS = {
+    "subsample_length": 3.5,
+    "frame_size": 0.025,
+    "frame_stride": 0.01,
+    "NFFT": 512,
+    "nfilt": 40,
+    "num_ceps": 12,
+    "cep_lifter": 22,
+}
+
+def mfcc_params(params=None):
+    '''All MFCC parameters, defaults filled in and types fixed so equal
+       settings always look the same. Raises ValueError on unknown ones
+    '''
+    params = dict(params or {})
+    unknown = set(params) - set(MFCC_DEFAULTS)
+    if unknown:
+        raise ValueError("Unknown mfcc parameters %s" % ", ".join(sorted(unknown)))
+    return {key: type(default)(params.get(key, default)) for key, default in MFCC_DEFAULTS.items()}
+
+def mfcc_key(params=None):
+    '''Short stable hash of a parameter set, the db.features key'''
+    encoded = json.dumps(mfcc_params(params), sort_keys=True)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()[:16]
+
+DEFAULT_KEY = mfcc_key()
+
+def instance_source(db, dsid, params=None):
+    '''(collection, query) to load the instances of dsid featurized with params'''
+    key = mfcc_key(params)
+    if key == DEFAULT_KEY:
+        return db.labeledinstances, {"dsid": dsid}
+    return db.features, {"dsid": dsid, "params": key}
+
+def materialize_features(db, dsid, params, batch=LOAD_BATCH_SIZE):
+    '''Compute and cache the features of every instance of dsid that does
+       not have them yet for params (blocking, takes a pymongo database).
+       Instances stored without audio, or with less of it than
+       subsample_length, are skipped. Returns (computed, skipped)
+    '''
+    params = mfcc_params(params)
+    key = mfcc_key(params)
+    done = set(db.features.distinct("instance", {"dsid": dsid, "params": key}))
+    skipped = db.labeledinstances.count_documents({"dsid": dsid, "audio": {"$exists": False}})
+
+    computed = 0
+    pending = {} # sample_rate -> documents waiting for a batch
+    def flush(sample_rate):
+        docs = pending.pop(sample_rate)
+        # scaled the way AddDataPoint scales signals before featurizing
+        signals = [decode_audio(doc) * 10000 for doc in docs]
+        mfcc = batch_mfcc(signals, sample_rate, dtype=np.float32, **params)
+        db.features.insert_many([dict(encode_feature(m, binary=True), instance=doc["_id"], dsid=dsid, params=key, label=doc["label"])
+                                 for doc, m in zip(docs, mfcc)], ordered=False)
+        return len(docs)
+
+    cursor = db.labeledinstances.find({"dsid": dsid, "audio": {"$exists": True}},
+                                      {"audio": 1, "audio_scale": 1, "sample_rate": 1, "label": 1}).batch_size(batch)
+    for doc in cursor:
+        if doc["_id"] in done:
+            continue
+        if len(doc["audio"]) // 2 < int(params["subsample_length"] * doc["sample_rate"]):
+            skipped += 1
+            continue
+        pending.setdefault(doc["sample_rate"], []).append(doc)
+        if len(pending[doc["sample_rate"]]) == batch:
+            computed += flush(doc["sample_rate"])
+    for sample_rate in list(pending):
+        computed += flush(sample_rate)
+    return computed, skipped
+
+
+class FeatureJob():
+    def __init__(self, dsid, params):
+        self.job_id = uuid.uuid4().hex
+        self.dsid = dsid
+        self.params = params
+        self.key = mfcc_key(params)
+        self.status = 'queued' # queued -> computing -> done | failed
+        self.computed = 0
+        self.skipped = 0
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.done = Future() # resolves once the job is done or failed
+
+    def to_json(self):
+        res = {"job_id": self.job_id,
+               "dsid": self.dsid,
+               "mfcc": self.params,
+               "status": self.status,
+               "computed": self.computed,
+               "skipped": self.skipped,
+               "created": self.created,
+               "finished": self.finished}
+        if self.error:
+            res["error"] = self.error
+        return res
+
+
+class FeatureQueue():
+    '''Runs materialize_features off the IOLoop and publishes the status
+       of the jobs to db.jobs (see jobs.py). Requests for a dsid and
+       parameter set that is already being computed, by any worker, join
+       that job
+    '''
+    def __init__(self, application, executor=None, history=200):
+        self.application = application
+        self.executor = executor # None is the IOLoop's default pool
+        self.board = JobBoard(application, 'features', history=history)
+
+    @property
+    def db(self):
+        return self.application.db
+
+    async def submit(self, dsid, params):
+        '''Fill in the features of dsid for params, returns the job_id'''
+        job = FeatureJob(dsid, mfcc_params(params))
+        lock = "features:%s:%s" % (dsid, job.key)
+        await self.board.publish(job)
+        holder = await self.board.claim(lock, 'active', job.job_id)
+        if holder != job.job_id:
+            await self.board.discard(job.job_id)
+            return holder
+        self.board.add(job)
+        IOLoop.current().spawn_callback(self._run, job, lock)
+        return job.job_id
+
+    async def status(self, job_id):
+        return await self.board.status(job_id)
+
+    async def wait(self, job_id):
+        '''Status of a job once it is done or failed'''
+        return await self.board.wait(job_id)
+
+    async def _run(self, job, lock):
+        job.status = 'computing'
+        try:
+            await self.board.publish(job)
+            job.computed, job.skipped = await IOLoop.current().run_in_executor(
+                self.executor, materialize_features, self.db.delegate, job.dsid, job.params)
+            job.status = 'done'
+        except Exception as e:
+            print(e)
+            job.status, job.error = 'failed', "error computing features"
+        finally:
+            job.finished = time.time()
+            try:
+                await self.board.publish(job)
+                await self.board.release(lock, 'active', job.job_id)
+            finally:
+                job.done.set_result(job)
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+'''Background job status and coalescing shared by every worker process
+
+With --processes N any worker may answer the poll for a job another
+worker runs, so the state of training and feature jobs lives in db.jobs:
+
+    {"_id": job_id, "kind": "training", "worker": "host:pid",
+     "updated": ..., <everything the job's to_json() returns>}
+
+and which job holds a dataset lives in db.joblocks, one document per
+lock with a job_id in each slot:
+
+    {"_id": "training:3", "queued": job_id, "running": job_id}
+
+Slots are taken with conditional updates, so two workers never start
+jobs for the same lock at once. A slot whose job finished, or whose
+worker has not touched it for JOB_TIMEOUT seconds (it died), is free.
+Finished jobs are dropped from db.jobs after JOB_HISTORY seconds.
+'''
+
+from collections import OrderedDict
+import datetime
+import os
+import socket
+import time
+
+from pymongo.errors import DuplicateKeyError
+from tornado import gen
+
+# a job not updated for this long belongs to a worker that is gone
+JOB_TIMEOUT = 3600
+
+# finished jobs stay visible to /TrainingStatus and /FeatureStatus this long
+JOB_HISTORY = 24 * 3600
+
+FINISHED = ('done', 'failed')
+
+def worker_name():
+    # not cached, workers fork after this module is imported
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+def ensure_job_indexes(db):
+    '''Indexes of db.jobs, safe to call on every startup'''
+    db.jobs.create_index([("kind", 1), ("dsid", 1), ("created", -1)])
+    db.jobs.create_index("finished_at", expireAfterSeconds=JOB_HISTORY)
+
+
+class JobBoard():
+    '''db.jobs and db.joblocks for one kind of job. Jobs started in this
+       process are also kept in jobs (the last history of them), so their
+       status and completion are read without a round-trip. A job is
+       anything with job_id, dsid, created, status, done (a Future) and
+       to_json()
+    '''
+    def __init__(self, application, kind, poll=0.1, history=200):
+        self.application = application
+        self.kind = kind
+        self.poll = poll
+        self.history = history
+        self.jobs = OrderedDict() # job_id -> job started here, oldest first
+
+    @property
+    def db(self):
+        return self.application.db
+
+    async def publish(self, job):
+        '''Write the current state of a job of ours to db.jobs'''
+        doc = job.to_json()
+        doc.update({"_id": job.job_id, "kind": self.kind, "worker": worker_name(), "updated": time.time()})
+        if job.status in FINISHED:
+            doc["finished_at"] = datetime.datetime.now(datetime.timezone.utc) # expires the document
+        await self.db.jobs.replace_one({"_id": job.job_id}, doc, upsert=True)
+
+    def add(self, job):
+        '''Keep a job that runs in this process'''
+        self.jobs[job.job_id] = job
+        while len(self.jobs) > self.history:
+            self.jobs.popitem(last=False)
+
+    async def discard(self, job_id):
+        '''Forget a job that was never started'''
+        self.jobs.pop(job_id, None)
+        await self.db.jobs.delete_one({"_id": job_id})
+
+    async def status(self, job_id):
+        '''to_json() of a job, run by any worker, None if there is no such job'''
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return dict(job.to_json(), worker=worker_name())
+        return self._public(await self.db.jobs.find_one({"_id": job_id, "kind": self.kind}))
+
+    async def latest(self, dsid):
+        '''Status of the most recently submitted job for dsid'''
+        doc = await self.db.jobs.find_one({"kind": self.kind, "dsid": dsid}, sort=[("created", -1)])
+        return self._public(doc)
+
+    async def wait(self, job_id):
+        '''Status of a job once it is done or failed'''
+        job = self.jobs.get(job_id)
+        if job is not None:
+            await job.done
+            return dict(job.to_json(), worker=worker_name())
+        while True:
+            status = await self.status(job_id)
+            if status is None or status["status"] in FINISHED:
+                return status
+            await gen.sleep(self.poll)
+
+    async def claim(self, lock, slot, job_id):
+        '''Put job_id in a free slot of lock. Returns the job that holds
+           the slot afterwards, job_id if we got it
+        '''
+        while True:
+            try:
+                await self.db.joblocks.update_one({"_id": lock, slot: None}, {"$set": {slot: job_id}}, upsert=True)
+                return job_id
+            except DuplicateKeyError:
+                pass # the slot is taken
+            holder = await self._holder(lock, slot)
+            if holder is not None:
+                return holder
+
+    async def move(self, lock, job_id, src, dst):
+        '''Move job_id from slot src to slot dst once dst is free'''
+        while True:
+            res = await self.db.joblocks.update_one({"_id": lock, src: job_id, dst: None},
+                                                    {"$set": {dst: job_id, src: None}})
+            if res.matched_count:
+                return
+            if await self._holder(lock, dst) is not None:
+                # still running, keep our job from looking abandoned meanwhile
+                await self.db.jobs.update_one({"_id": job_id}, {"$set": {"updated": time.time()}})
+                await gen.sleep(self.poll)
+
+    async def release(self, lock, slot, job_id):
+        await self.db.joblocks.update_one({"_id": lock, slot: job_id}, {"$set": {slot: None}})
+
+    async def _holder(self, lock, slot):
+        # job in the slot if it is still alive, else free the slot and return None
+        doc = await self.db.joblocks.find_one({"_id": lock})
+        holder = (doc or {}).get(slot)
+        if holder is None:
+            return None
+        job = await self.db.jobs.find_one({"_id": holder}, {"status": 1, "updated": 1})
+        if job is not None and job["status"] not in FINISHED and job["updated"] > time.time() - JOB_TIMEOUT:
+            return holder
+        await self.db.joblocks.update_one({"_id": lock, slot: holder}, {"$set": {slot: None}})
+        return None
+
+    def _public(self, doc):
+        if doc is None:
+            return None
+        for key in ("_id", "kind", "updated", "finished_at"):
+            doc.pop(key, None)
+        return doc
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+'''Neighbour-search backends for the knn classifier slot
+
+MFCC features are ~4k dimensional, so the default KNeighborsClassifier
+ends up brute forcing every prediction. UpdateModel picks a backend with
+a "backend" entry in the knn kwargs, everything else is passed on:
+
+    {"knn": {"n_neighbors": 3}}                                      exact (default)
+    {"knn": {"n_neighbors": 3, "backend": "pca", "n_components": 32}} PCA, then a ball tree
+    {"knn": {"n_neighbors": 3, "backend": "lsh", "n_bits": 8}}        random-projection LSH
+
+The approximate backends take extend(f, l) to add instances without a
+full refit (see training.update_classifier).
+'''
+
+from collections import Counter
+
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.decomposition import PCA
+from sklearn.neighbors import KNeighborsClassifier
+
+
+def make_knn(backend='exact', **params):
+    '''knn classifier for UpdateModel's knn kwargs'''
+    if backend == 'exact':
+        return KNeighborsClassifier(**params)
+    elif backend == 'pca':
+        return PCANeighborsClassifier(**params)
+    elif backend == 'lsh':
+        return LSHNeighborsClassifier(**params)
+    raise ValueError("Unknown knn backend %s" % backend)
+
+
+class PCANeighborsClassifier(BaseEstimator, ClassifierMixin):
+    '''Project onto the top n_components principal axes, then run an
+       exact KNN with a ball tree in that space. The tree only prunes
+       well in low dimensions, which the projection provides
+    '''
+    def __init__(self, n_neighbors=5, n_components=32, weights='uniform', leaf_size=30, random_state=0):
+        self.n_neighbors = n_neighbors
+        self.n_components = n_components
+        self.weights = weights
+        self.leaf_size = leaf_size
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        X = np.asarray(X, dtype=np.float64)
+        self.pca_ = PCA(n_components=min(self.n_components, X.shape[0], X.shape[1]), random_state=self.random_state)
+        # the projected training set, so extend does not depend on sklearn internals
+        self.Z_, self.y_ = self.pca_.fit_transform(X), np.asarray(y)
+        self.knn_ = self._knn().fit(self.Z_, self.y_)
+        self.classes_ = self.knn_.classes_
+        return self
+
+    def extend(self, X, y):
+        '''Add instances, keeping the projection and rebuilding the tree'''
+        self.Z_ = np.concatenate((self.Z_, self.pca_.transform(np.asarray(X, dtype=np.float64))))
+        self.y_ = np.concatenate((self.y_, y))
+        self.knn_ = self._knn().fit(self.Z_, self.y_)
+        self.classes_ = self.knn_.classes_
+        return self
+
+    def predict(self, X):
+        return self.knn_.predict(self.pca_.transform(np.asarray(X, dtype=np.float64)))
+
+    def kneighbors(self, X, n_neighbors=None):
+        return self.knn_.kneighbors(self.pca_.transform(np.asarray(X, dtype=np.float64)), n_neighbors)
+
+    def _knn(self):
+        return KNeighborsClassifier(n_neighbors=self.n_neighbors, weights=self.weights,
+                                    algorithm='ball_tree', leaf_size=self.leaf_size)
+
+
+class LSHNeighborsClassifier(BaseEstimator, ClassifierMixin):
+    '''Approximate KNN with random-projection (sign) hashing in pure numpy.
+       Each of n_tables hashes a point to n_bits signs of random
+       projections; a query only computes exact distances to the points
+       sharing a bucket with it in some table. When the buckets hold fewer
+       than n_neighbors points the query falls back to brute force
+    '''
+    def __init__(self, n_neighbors=5, n_bits=8, n_tables=24, random_state=0):
+        self.n_neighbors = n_neighbors
+        self.n_bits = n_bits
+        self.n_tables = n_tables
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        X = np.asarray(X, dtype=np.float32)
+        rng = np.random.RandomState(self.random_state)
+        self.mean_ = X.mean(axis=0)
+        self.planes_ = rng.normal(size=(self.n_tables, X.shape[1], self.n_bits)).astype(np.float32)
+        self.classes_, self._y = np.unique(y, return_inverse=True)
+        self._fit_X = X
+        self._index()
+        return self
+
+    def extend(self, X, y):
+        '''Add instances under the same hash functions, rebuilding the buckets'''
+        labels = np.concatenate((self.classes_[self._y], y))
+        self.classes_, self._y = np.unique(labels, return_inverse=True)
+        self._fit_X = np.concatenate((self._fit_X, np.asarray(X, dtype=np.float32)))
+        self._index()
+        return self
+
+    def _hash(self, X):
+        # (n_tables, n) integer bucket codes
+        bits = np.einsum('nd,tdb->tnb', X - self.mean_, self.planes_) > 0
+        return bits.astype(np.int64).dot(1 << np.arange(self.n_bits, dtype=np.int64))
+
+    def _index(self):
+        self.tables_ = []
+        for codes in self._hash(self._fit_X):
+            order = np.argsort(codes, kind='stable')
+            keys, starts = np.unique(codes[order], return_index=True)
+            self.tables_.append(dict(zip(keys.tolist(), np.split(order, starts[1:]))))
+
+    def kneighbors(self, X, n_neighbors=None):
+        '''(distances, indices) of the approximate nearest neighbours'''
+        k = min(n_neighbors or self.n_neighbors, len(self._fit_X))
+        X = np.asarray(X, dtype=np.float32)
+        codes = self._hash(X)
+        dist = np.empty((len(X), k))
+        ind = np.empty((len(X), k), dtype=np.int64)
+        everything = np.arange(len(self._fit_X))
+        for i, x in enumerate(X):
+            buckets = [table.get(code) for table, code in zip(self.tables_, codes[:, i].tolist())]
+            candidates = [b for b in buckets if b is not None]
+            candidates = np.unique(np.concatenate(candidates)) if candidates else everything
+            if len(candidates) < k:
+                candidates = everything
+            d = np.sum((self._fit_X[candidates] - x) ** 2, axis=1)
+            nearest = np.argpartition(d, k - 1)[:k] if len(d) > k else np.arange(len(d))
+            nearest = nearest[np.argsort(d[nearest])]
+            dist[i], ind[i] = np.sqrt(d[nearest]), candidates[nearest]
+        return dist, ind
+
+    def predict(self, X):
+        dist, ind = self.kneighbors(X)
+        votes = [Counter(row).most_common(1)[0][0] for row in self._y[ind]]
+        return self.classes_[votes]
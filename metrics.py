@@ -0,0 +1,229 @@
+#!/usr/bin/python
+'''Per-stage latency histograms, a Prometheus text exposition of them and
+a sampling profiler for slow requests
+
+Handlers time their stages with self.timer (a StageTimer):
+
+    with self.timer('mfcc'):
+        filt, mfcc = au.get_filter_mfcc()
+
+and BaseHandler.on_finish hands the stages and the total to
+Metrics.observe_request, labeled with the handler name and the dsid the
+request was about. GET /metrics renders everything for Prometheus.
+
+Everything here is per worker process. With --processes N each scrape
+of /metrics (and each GET /SlowRequests or /ModelCacheStats) is answered
+by whichever worker the connection lands on, so every series carries a
+worker="host:pid" label: sum over it in queries, and expect a worker's
+series to go stale between the scrapes that reach it.
+'''
+
+from collections import Counter, deque
+from contextlib import contextmanager
+import os
+import sys
+import threading
+import time
+
+from jobs import worker_name
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class StageTimer():
+    '''Seconds spent per named stage of one request, stages can repeat'''
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+class Histogram():
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets) # not cumulative, render() adds them up
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += seconds
+        self.count += 1
+
+
+def format_labels(labels):
+    return ",".join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels)
+
+
+class Metrics():
+    '''Histograms of request stages by (endpoint, stage, dsid) and of MFCC
+       calls by sample rate. At most max_dsids dsids get a label of their
+       own, the rest are counted as "other". Thread safe, the MFCC hook
+       fires in executor threads
+    '''
+    def __init__(self, application=None, max_dsids=100):
+        self.application = application
+        self.max_dsids = max_dsids
+        self.dsids = set()
+        self.requests = {} # (endpoint, stage, dsid) -> Histogram
+        self.mfcc = {} # (sample_rate, kind) -> Histogram
+        self.mfcc_clips = Counter()
+        self.lock = threading.Lock()
+
+    def observe_request(self, endpoint, stages, total, dsid=None):
+        '''Record the stage timings of a finished request, "total" is the
+           whole request as tornado saw it
+        '''
+        if dsid is None:
+            dsid = ""
+        elif dsid not in self.dsids:
+            if len(self.dsids) < self.max_dsids:
+                self.dsids.add(dsid)
+            else:
+                dsid = "other"
+        with self.lock:
+            for stage, seconds in list(stages.items()) + [("total", total)]:
+                key = (endpoint, stage, dsid)
+                if key not in self.requests:
+                    self.requests[key] = Histogram()
+                self.requests[key].observe(seconds)
+
+    def observe_mfcc(self, sample_rate, clips, seconds):
+        '''audioutility.MFCC_HOOKS callback'''
+        kind = "batch" if clips > 1 else "single"
+        with self.lock:
+            key = (sample_rate, kind)
+            if key not in self.mfcc:
+                self.mfcc[key] = Histogram()
+            self.mfcc[key].observe(seconds)
+            self.mfcc_clips[sample_rate] += clips
+
+    def watch_mfcc(self):
+        '''Time every get_filter_mfcc and batch_mfcc call in this process'''
+        import audioutility
+        if self.observe_mfcc not in audioutility.MFCC_HOOKS:
+            audioutility.MFCC_HOOKS.append(self.observe_mfcc)
+
+    def render(self):
+        '''Everything in the Prometheus text exposition format'''
+        lines = []
+        worker = format_labels([("worker", worker_name())])
+        with self.lock:
+            lines += self._histograms("sklearn_request_stage_seconds", "Time spent in each stage of a request",
+                                      (("endpoint", "stage", "dsid"), self.requests), worker)
+            lines += self._histograms("sklearn_mfcc_seconds", "Duration of get_filter_mfcc (single) and batch_mfcc (batch) calls",
+                                      (("sample_rate", "kind"), self.mfcc), worker)
+            if self.mfcc_clips:
+                lines += ["# HELP sklearn_mfcc_clips_total Clips featurized",
+                          "# TYPE sklearn_mfcc_clips_total counter"]
+                lines += ['sklearn_mfcc_clips_total{%s,sample_rate="%s"} %d' % ((worker,) + item) for item in sorted(self.mfcc_clips.items())]
+        lines += self._application_lines(worker)
+        return "\n".join(lines) + "\n"
+
+    def _histograms(self, name, help, labeled, worker):
+        names, histograms = labeled
+        if not histograms:
+            return []
+        lines = ["# HELP %s %s" % (name, help), "# TYPE %s histogram" % name]
+        for key in sorted(histograms, key=lambda k: tuple(map(str, k))):
+            hist = histograms[key]
+            labels = worker + "," + format_labels(zip(names, key))
+            cumulative = 0
+            for bound, count in zip(hist.buckets, hist.counts):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%g"} %d' % (name, labels, bound, cumulative))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, hist.count))
+            lines.append('%s_sum{%s} %.6f' % (name, labels, hist.sum))
+            lines.append('%s_count{%s} %d' % (name, labels, hist.count))
+        return lines
+
+    def _application_lines(self, worker):
+        # counters the model cache, the prediction cache and the batcher already keep
+        lines = []
+        app = self.application
+        if app is None:
+            return lines
+        for prefix, stats, counters, gauges in (
+                ("sklearn_model_cache", app.loader.models.stats(), ("hits", "misses", "evictions"), ("entries", "bytes")),
+                ("sklearn_prediction_cache", app.predictions.stats(), ("hits", "misses", "evictions"), ("entries",)),
+                ("sklearn_batcher", app.batcher.stats(), ("batches", "predictions"), ())):
+            for key in counters:
+                lines += ["# TYPE %s_%s_total counter" % (prefix, key),
+                          "%s_%s_total{%s} %d" % (prefix, key, worker, stats[key])]
+            for key in gauges:
+                lines += ["# TYPE %s_%s gauge" % (prefix, key),
+                          "%s_%s{%s} %d" % (prefix, key, worker, stats[key])]
+        return lines
+
+
+# innermost frames of threads that are only waiting for work
+IDLE_FILES = ("threading.py", "selectors.py", "queue.py", os.path.join("concurrent", "futures", "thread.py"))
+
+class SlowRequestProfiler():
+    '''Samples the stacks of every thread each interval seconds while
+       enabled and keeps the last few seconds of samples. Requests slower
+       than threshold get the samples taken while they ran folded into
+       their most common stacks, the last keep of them are kept around
+       (GET /SlowRequests)
+    '''
+    def __init__(self, threshold=0.0, interval=0.005, horizon=30.0, keep=20, depth=12):
+        self.interval = interval
+        self.depth = depth
+        self.samples = deque(maxlen=int(horizon / interval))
+        self.slow = deque(maxlen=keep)
+        self.threshold = 0.0
+        self.thread = None
+        self.set_threshold(threshold)
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def set_threshold(self, threshold):
+        '''Profile requests slower than threshold seconds, 0 turns it off'''
+        self.threshold = threshold
+        if self.enabled and self.thread is None:
+            self.thread = threading.Thread(target=self._sample, name="slow-request-profiler", daemon=True)
+            self.thread.start()
+
+    def _sample(self):
+        me = threading.get_ident()
+        while self.enabled:
+            now = time.perf_counter()
+            for ident, frame in sys._current_frames().items():
+                if ident == me or frame.f_code.co_filename.endswith(IDLE_FILES):
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.depth:
+                    code = frame.f_code
+                    stack.append("%s:%s:%d" % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                    frame = frame.f_back
+                self.samples.append((now, ";".join(reversed(stack))))
+            time.sleep(self.interval)
+        self.thread = None
+
+    def finish(self, endpoint, dsid, start, stages, total, top=10):
+        '''Called when a request that began at perf_counter() start is done'''
+        if not self.enabled or total < self.threshold:
+            return
+        stacks = Counter(stack for t, stack in list(self.samples) if t >= start)
+        self.slow.append({"endpoint": endpoint,
+                          "dsid": dsid,
+                          "time": time.time(),
+                          "total_ms": round(1000 * total, 3),
+                          "stages_ms": {stage: round(1000 * seconds, 3) for stage, seconds in stages.items()},
+                          "samples": sum(stacks.values()),
+                          "stacks": [{"stack": stack, "samples": count} for stack, count in stacks.most_common(top)]})
@@ -0,0 +1,291 @@
+#!/usr/bin/python
+'''Bounded in-memory caches of fitted models and of their recent
+predictions, shared by the handlers'''
+
+from collections import OrderedDict
+import hashlib
+import sys
+import time
+
+from gridfs.errors import NoFile
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+import numpy as np
+
+from metrics import StageTimer
+
+
+def estimate_size(obj, seen=None):
+    '''Rough number of bytes held by obj: numpy buffers plus the python
+       objects around them. Good enough to budget fitted estimators, a KNN
+       model is dominated by the copy of its training set
+    '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, np.ndarray):
+        # views are paid for by their base
+        size = sys.getsizeof(obj)
+        if obj.base is not None:
+            return size + estimate_size(obj.base, seen)
+        return size + obj.nbytes
+    if isinstance(obj, (str, bytes, bytearray, int, float, bool, type(None))):
+        return sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_size(k, seen) + estimate_size(v, seen) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(estimate_size(v, seen) for v in obj)
+    if hasattr(obj, '__dict__'):
+        return sys.getsizeof(obj) + estimate_size(vars(obj), seen)
+    # extension types (e.g. the KD/ball trees inside KNeighborsClassifier)
+    # expose their arrays through their pickled state
+    try:
+        return sys.getsizeof(obj) + estimate_size(obj.__getstate__(), seen)
+    except Exception:
+        return sys.getsizeof(obj)
+
+
+class ModelCache():
+    '''LRU mapping dsid -> {clf_name: estimator} with a budget on the
+       number of dsids and on their estimated size in bytes. Reads through
+       get() or [] count as hits or misses; `in` does not touch the order.
+       An entry bigger than the whole byte budget is still kept (alone)
+       rather than reloaded on every request
+    '''
+    def __init__(self, max_entries=64, max_bytes=512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # dsid -> (models, nbytes), least recently used first
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, dsid):
+        return dsid in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, dsid):
+        models = self.get(dsid)
+        if models is None:
+            raise KeyError(dsid)
+        return models
+
+    def get(self, dsid, default=None):
+        if dsid not in self.entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(dsid)
+        return self.entries[dsid][0]
+
+    def __setitem__(self, dsid, models):
+        self.put(dsid, models)
+
+    def put(self, dsid, models, nbytes=None):
+        '''Insert or replace the models for dsid, evicting least recently
+           used dsids until the budget holds again
+        '''
+        if nbytes is None:
+            nbytes = estimate_size(models)
+        self.pop(dsid, None)
+        self.entries[dsid] = (models, nbytes)
+        self.nbytes += nbytes
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.nbytes > self.max_bytes):
+            self._evict()
+
+    def __delitem__(self, dsid):
+        models, nbytes = self.entries.pop(dsid)
+        self.nbytes -= nbytes
+
+    def pop(self, dsid, default=None):
+        if dsid not in self.entries:
+            return default
+        models = self.entries[dsid][0]
+        del self[dsid]
+        return models
+
+    def _evict(self):
+        dsid, (models, nbytes) = self.entries.popitem(last=False)
+        self.nbytes -= nbytes
+        self.evictions += 1
+
+    def stats(self):
+        '''Counters for monitoring'''
+        return {"entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+
+class PredictionCache():
+    '''LRU of recent PredictOne results, keyed by a digest of the signal and
+       of the model that predicted it (dsid, clf_name and the version of
+       its db.models document), so a retrained model never answers from an
+       old entry. Entries expire after ttl seconds; invalidate(dsid) frees
+       a retrained dsid's entries right away. max_entries 0 turns it off
+    '''
+    def __init__(self, max_entries=10000, ttl=300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict() # (dsid, digest) -> (label, expires), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(signal, sample_rate, dsid, clf_name, version):
+        h = hashlib.blake2b(np.ascontiguousarray(signal).view(np.uint8), digest_size=16)
+        h.update(repr((signal.dtype.str, sample_rate, dsid, clf_name, version)).encode("utf-8"))
+        return dsid, h.digest()
+
+    def get(self, key):
+        '''Cached label for key, None if there is none (or it expired)'''
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] < time.monotonic():
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, label):
+        if not self.max_entries:
+            return
+        self.entries[key] = (label, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, dsid):
+        '''Drop every entry of dsid, returns how many there were'''
+        keys = [key for key in self.entries if key[0] == dsid]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+    def stats(self):
+        '''Counters for monitoring'''
+        return {"entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+
+class ModelLoader():
+    '''Fills a ModelCache from db.models without blocking the IOLoop.
+       The lookup is async and reading the models runs in a thread; concurrent
+       misses on one dsid wait for the same load (single flight) and the
+       cache only ever sees complete entries.
+       Every entry remembers the version stamp of the db.models document it
+       came from; refresh() drops entries that were retrained elsewhere,
+       e.g. by another worker process, and with them their cached
+       predictions
+    '''
+    def __init__(self, application, models, predictions=None):
+        self.application = application
+        self.models = models
+        self.predictions = predictions
+        self.loading = {} # dsid -> Future of the load in flight
+        self.versions = {} # dsid -> version of the cached models
+
+    @property
+    def db(self):
+        return self.application.db
+
+    @property
+    def store(self):
+        return self.application.store
+
+    async def get(self, dsid, timer=None):
+        '''Models for dsid, None if nothing was trained for it. The request
+           that starts a load gets its db_lookup and deserialize stages
+           added to timer
+        '''
+        models = self.models.get(dsid)
+        if models is not None:
+            return models
+
+        future = self.loading.get(dsid)
+        if future is None:
+            future = gen.convert_yielded(self._load(dsid, timer or StageTimer()))
+            self.loading[dsid] = future
+            future.add_done_callback(lambda f: self.loading.pop(dsid, None))
+        return await future
+
+    async def _load(self, dsid, timer):
+        with timer('db_lookup'):
+            tmp = await self.db.models.find_one({"dsid":dsid})
+        if not tmp:
+            return None
+        try:
+            with timer('deserialize'):
+                models = await IOLoop.current().run_in_executor(None, self.store.load, tmp)
+        except NoFile:
+            # a retrain replaced the files after we read the document
+            tmp = await self.db.models.find_one({"dsid":dsid})
+            with timer('deserialize'):
+                models = await IOLoop.current().run_in_executor(None, self.store.load, tmp)
+        # a retrain may have finished while we were reading, its models win
+        if dsid in self.models:
+            return self.models.get(dsid)
+        self.put(dsid, models, tmp.get('version'))
+        return models
+
+    def put(self, dsid, models, version=None):
+        '''Cache models for dsid read from the given version of its document'''
+        # memory-mapped arrays are not counted, they live in the page cache
+        self.models.put(dsid, models, nbytes=estimate_size(models))
+        if self.predictions is not None and version != self.versions.get(dsid, version):
+            # retrained; reloading the same version (after an eviction) keeps
+            # its predictions, their keys carry the version anyway
+            self.predictions.invalidate(dsid)
+        self.versions[dsid] = version
+
+    async def refresh(self):
+        '''Drop cached models whose db.models version changed, returns their dsids'''
+        cached = list(self.models.entries)
+        if not cached:
+            return []
+        cursor = self.db.models.find({"dsid": {"$in": cached}}, {"dsid": 1, "version": 1})
+        current = {doc["dsid"]: doc.get("version") for doc in await cursor.to_list(None)}
+        stale = [dsid for dsid in cached
+                 if dsid in self.models and current.get(dsid, -1) != self.versions.get(dsid)]
+        for dsid in stale:
+            self.models.pop(dsid)
+            if self.predictions is not None:
+                self.predictions.invalidate(dsid)
+        return stale
+
+    def watch(self, interval):
+        '''refresh() every interval seconds'''
+        callback = PeriodicCallback(self.refresh, interval * 1000)
+        callback.start()
+        return callback
+
+    async def warm_up(self, count):
+        '''Preload the count most recently trained dsids, returns them'''
+        cursor = self.db.models.find({}, {"dsid": 1}).sort("updated", -1).limit(count)
+        dsids = [doc["dsid"] for doc in await cursor.to_list(None)]
+        for dsid in dsids:
+            try:
+                await self.get(dsid)
+            except Exception as e:
+                print("Could not preload models for dsid %s: %s" % (dsid, e))
+        return dsids
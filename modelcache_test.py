@@ -0,0 +1,25 @@
+import numpy as np
+from sklearn.neighbors import KNeighborsClassifier
+
+from modelcache import ModelCache, estimate_size
+
+
+def test_estimate_counts_training_set():
+    f = np.random.rand(200, 500)
+    knn = KNeighborsClassifier(n_neighbors=1).fit(f, np.arange(200) % 2)
+    assert estimate_size({'knn': knn}) >= f.nbytes
+
+
+def test_lru_eviction_by_entries_and_bytes():
+    cache = ModelCache(max_entries=2, max_bytes=1000)
+    cache.put(1, {}, nbytes=100)
+    cache.put(2, {}, nbytes=100)
+    assert cache.get(1) == {}          # 2 is now least recently used
+    cache.put(3, {}, nbytes=100)
+    assert 2 not in cache and 1 in cache and 3 in cache
+
+    cache.put(4, {}, nbytes=950)       # over the byte budget, only 4 fits
+    assert list(cache.entries) == [4]
+    assert cache.get(2) is None
+    assert cache.stats() == {"entries": 1, "max_entries": 2, "bytes": 950, "max_bytes": 1000,
+                             "hits": 1, "misses": 1, "evictions": 3}
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+'''Fitted models stored outside the db.models documents
+
+Each estimator is serialized with joblib, which writes numpy arrays as
+raw buffers next to a small pickle, and uploaded to the GridFS bucket
+"modelfiles". The models document only references the files:
+
+    {"dsid": 3, "version": 7, "updated": ...,
+     "knn_file": ObjectId(...), "knn_params": {...}, ...}
+
+so a large KNN model no longer counts against the 16MB document limit.
+Loads go through a local directory of the same files, downloaded once,
+and memory-map their arrays instead of copying them onto the heap.
+Documents written before this still hold "{clf_name}_model" pickles and
+load as before.
+
+These are blocking helpers, run them off the IOLoop.
+'''
+
+import io
+import os
+import pickle
+import tempfile
+
+import gridfs
+import joblib
+
+
+def stored_classifiers(doc):
+    '''Names of the classifiers a db.models document holds, either format'''
+    if not doc:
+        return set()
+    return set(key[:-len(suffix)] for key in doc
+               for suffix in ('_file', '_model') if key.endswith(suffix))
+
+
+class ModelStore():
+    '''Writes fitted estimators to GridFS and reads them back through
+       files in directory, named after dsid, version, classifier and
+       GridFS id, so a local file is never stale. compress (0-9) shrinks
+       the files, but compressed arrays cannot be memory-mapped
+    '''
+    def __init__(self, database, directory, compress=0):
+        self.bucket = gridfs.GridFSBucket(database, 'modelfiles')
+        self.directory = directory
+        self.compress = compress
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, dsid, version, key, file_id):
+        return os.path.join(self.directory, '%s-%s-%s-%s.joblib' % (dsid, version, key, file_id))
+
+    def save(self, dsid, version, fitted):
+        '''Store {clf_name: estimator}, returns the fields to $set on the
+           models document
+        '''
+        fields = {}
+        for key, clf in fitted.items():
+            buf = io.BytesIO()
+            joblib.dump(clf, buf, compress=self.compress)
+            buf.seek(0)
+            file_id = self.bucket.upload_from_stream('%s-%s-%s' % (dsid, version, key), buf,
+                                                     metadata={"dsid": dsid, "version": version, "clf_name": key})
+            # we just wrote it, keep the local copy too
+            self._write(self.path(dsid, version, key, file_id), buf.getvalue())
+            fields[key+'_file'] = file_id
+        return fields
+
+    def load(self, doc, mmap_mode='r'):
+        '''{clf_name: estimator} of a models document. mmap_mode 'c' gives
+           writable (copy on write) arrays, e.g. for partial_fit. Each
+           estimator gets the MFCC parameters it was fitted on as mfcc_params_
+        '''
+        if self.compress:
+            mmap_mode = None
+        models = {}
+        for key in stored_classifiers(doc):
+            if key+'_file' in doc:
+                models[key] = joblib.load(self.fetch(doc, key), mmap_mode=mmap_mode)
+            else:
+                models[key] = pickle.loads(doc[key+'_model'])
+            models[key].mfcc_params_ = doc.get('mfcc_params', {})
+        return models
+
+    def fetch(self, doc, key):
+        '''Local path of a stored estimator, downloading it if we have not yet'''
+        file_id = doc[key+'_file']
+        path = self.path(doc['dsid'], doc.get('version'), key, file_id)
+        if not os.path.exists(path):
+            buf = io.BytesIO()
+            self.bucket.download_to_stream(file_id, buf)
+            self._write(path, buf.getvalue())
+        return path
+
+    def delete(self, doc):
+        '''Drop the files of a models document that was replaced. Models
+           already mapped from them stay readable until they are released
+        '''
+        for key in stored_classifiers(doc):
+            if key+'_file' not in doc:
+                continue
+            try:
+                self.bucket.delete(doc[key+'_file'])
+            except gridfs.errors.NoFile:
+                pass
+            path = self.path(doc['dsid'], doc.get('version'), key, doc[key+'_file'])
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _write(self, path, data):
+        # write then rename, a concurrent reader never sees half a file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
@@ -2,27 +2,44 @@
 
 from pymongo import MongoClient
 import tornado.web
+import tornado.websocket
 
 from tornado.web import HTTPError
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
 from tornado.options import define, options
 
-from basehandler import BaseHandler
+from basehandler import BaseHandler, HTTPJSONError, json_str
 
-# model imports
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.svm import SVC
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import StandardScaler
-
-import pickle
-from bson.binary import Binary
 import json
 import numpy as np
 
-from audioutility import AudioUtility
+from bulkimport import import_clips, label_clips, tar_files
+from audioutility import AudioUtility, MfccStream, batch_mfcc, decode_pcm, get_mfcc_plan
+from dataset import encode_audio, encode_feature, next_dsid
+from features import mfcc_params
+from jobs import worker_name
+from metrics import StageTimer
+from training import CLASSIFIERS
+
+# AddDataPoint and PredictOne must featurize the same way, see MFCC_FLOAT32_ATOL
+MFCC_DTYPE = np.float32
+
+def predict_signals(clf, signals, sample_rate, timer=None):
+    '''Featurize (already scaled) signals the way the instances clf was
+       fitted on were featurized and predict all of them with one call
+    '''
+    timer = timer or StageTimer()
+    #model must be trained on the same kwargs, UpdateModel stamps them on clf
+    with timer('mfcc'):
+        mfcc = batch_mfcc(signals, sample_rate, dtype=MFCC_DTYPE, **getattr(clf, 'mfcc_params_', {}))
+    with timer('predict'):
+        return clf.predict(mfcc.reshape(len(signals), -1))
+
+def has_enough_data(clf, signal, sample_rate):
+    '''True if signal is long enough to featurize for clf'''
+    subsample_length = mfcc_params(getattr(clf, 'mfcc_params_', {}))['subsample_length']
+    return AudioUtility(signal=signal, sample_rate=sample_rate).has_enough_data(subsample_length)
 
 class PrintHandlers(BaseHandler):
     @tornado.web.authenticated
@@ -35,16 +52,17 @@ class PrintHandlers(BaseHandler):
 
 class UploadLabeledDatapointHandler(BaseHandler):
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         '''Save data point and class label to database
         '''
         self.set_header("Content-Type", "application/json")
         try:
-            data = json.loads(self.request.body.decode("utf-8"))
-            signal = list(data['signal'])
+            with self.timer('parse'):
+                data = self.get_signal_data(("sample_rate", "label", "dsid"))
+                signal = np.asarray(data['signal'], dtype=MFCC_DTYPE)
             sample_rate = int(data['sample_rate'])
             label = str(data['label'])
-            dsid  = int(data['dsid'])
+            dsid = self.dsid = int(data['dsid'])
         except:
             self.set_status(400) #Bad request
             self.write_json({"status":"invalid request body"})
@@ -52,12 +70,18 @@ class UploadLabeledDatapointHandler(BaseHandler):
 
         try:
             #preprocess the audio, since we are only training the ML model on the mfcc transformation
-            signal = [x*10000 for x in signal]
+            with self.timer('scale'):
+                signal = signal * 10000
             au = AudioUtility(signal=signal, sample_rate=sample_rate)
-            filt, mfcc = au.get_filter_mfcc() #model must be trained on default kwargs
-            instance = mfcc.flatten()
-            finstance = [float(val) for val in instance] # just in case
-            dbid = self.db.labeledinstances.insert({"feature":finstance,"label":label,"dsid":dsid})
+            with self.timer('mfcc'):
+                filt, mfcc = au.get_filter_mfcc(dtype=MFCC_DTYPE) #features for other kwargs come from the stored audio
+            with self.timer('encode'):
+                instance = encode_feature(mfcc, binary=self.settings.get('binary_features', False))
+                if self.settings.get('store_audio', True):
+                    instance.update(encode_audio(data['signal'], sample_rate))
+            instance.update({"label":label,"dsid":dsid})
+            with self.timer('db_insert'):
+                dbid = await self.db.labeledinstances.insert_one(instance)
         except Exception as e:
             print(e)
             self.set_status(400) #Bad request
@@ -66,129 +90,403 @@ class UploadLabeledDatapointHandler(BaseHandler):
 
         self.write_json({"status":"success"})
 
+class ImportDataset(BaseHandler):
+    @tornado.web.authenticated
+    async def post(self):
+        '''Add many labeled WAV clips to a dataset in one request, see
+           bulkimport.py for how clips get their labels. Body is a tar
+           (plain or compressed) or multipart/form-data with one file part
+           per clip; arguments dsid, optional label and split (seconds)
+        '''
+        self.set_header("Content-Type", "application/json")
+        try:
+            dsid = int(self.get_argument("dsid"))
+            label = self.get_argument("label", None)
+            split = self.get_argument("split", None)
+            split = float(split) if split else None
+            if self.request.files:
+                files = [(f.filename, f.body, field) for field, parts in self.request.files.items() for f in parts]
+            else:
+                files = tar_files(self.request.body)
+            clips = label_clips(files, label)
+            if not clips:
+                raise ValueError("no clips")
+        except:
+            self.set_status(400) #Bad request
+            self.write_json({"status":"invalid request body"})
+            return
+
+        res = await import_clips(self.db, clips, dsid, self.application.importer, split=split,
+                                 binary=self.settings.get('binary_features', False),
+                                 store_audio=self.settings.get('store_audio', True))
+        self.write_json(dict(res, status="success"))
+
 class RequestNewDatasetId(BaseHandler):
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         '''Get a new dataset ID for building a new dataset
         '''
         self.set_header("Content-Type", "application/json")
-        a = self.db.labeledinstances.find_one(sort=[("dsid", -1)])
-        if a == None:
-            newSessionId = 1
-        else:
-            newSessionId = float(a['dsid'])+1
+        # an atomic counter, concurrent requests never get the same id
+        newSessionId = await self.db.counters.run(next_dsid)
         self.write_json({"status": "success", "dsid":newSessionId})
 
 class UpdateModel(BaseHandler):
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         '''Train a new model (or update) for given dataset ID
+           Training runs in the background, the response carries a job_id
+           to poll /TrainingStatus with. Send "wait": true to get the
+           resubstitution accuracy back in this response instead.
+           Body holds kwargs for any of "knn", "svm", "sgd"; with
+           "incremental": true only instances added since the last fit
+           are loaded, unless the classifiers or their kwargs changed.
+           "mfcc": {"nfilt": 26, ...} fits on features computed with
+           other get_filter_mfcc kwargs, from the stored audio
         '''
         self.set_header("Content-Type", "application/json")
-        f_res = {"status": "success"}
         try:
-            data = json.loads(self.request.body.decode("utf-8")) 
-            dsid = data['dsid']
-            knn = data['knn']
-            svm = data['svm']
+            with self.timer('parse'):
+                data = json.loads(self.request.body.decode("utf-8"))
+            dsid = self.dsid = data['dsid']
+            params = {key: dict(data[key]) for key in CLASSIFIERS if key in data}
+            incremental = bool(data.get('incremental', self.settings.get('incremental_training', False)))
+            mfcc = mfcc_params(data.get('mfcc'))
+            if not params:
+                raise KeyError("no classifiers")
         except:
             self.set_status(400) #Bad request
             self.write_json({"status":"invalid request body"})
             return
-        
-        try:
-            # create feature vectors from database
-            f=[]
-            for a in self.db.labeledinstances.find({"dsid":dsid}): 
-                f.append([float(val) for val in a['feature']])
-
-            # create label vector from database
-            l=[]
-            for a in self.db.labeledinstances.find({"dsid":dsid}): 
-                l.append(a['label'])
 
-            if len(set(l)) < 2:
+        # unknown kwargs (or knn backends) fail here rather than in the job
+        for key, kwargs in params.items():
+            try:
+                CLASSIFIERS[key](**kwargs)
+            except Exception as e:
                 self.set_status(400) #Bad request
-                self.write_json({"status":"Need > class labels"})
+                self.write_json({"status":"invalid %s parameters: %s" % (key, e)})
                 return
 
-            self.models[dsid] = {} # clear current models
-            self.models[dsid]['knn'] = KNeighborsClassifier(**data['knn'])
-            self.models[dsid]['svm'] = SVC(**data['svm'])
-
-            # fit the model to the data
-            acc = {}
-            if l:
-                for key, clf in self.models[dsid].items():
-                    clf.fit(f,l)
-                    lstar = clf.predict(f)
-                    f_res[key] = str(sum(lstar==l)/float(len(l)))
-                    bytes = pickle.dumps(clf)
-
-                    set_obj = {}
-                    set_obj[key+'_model'] = Binary(bytes)
-
-                    self.db.models.update(
-                        {
-                            "dsid":dsid
-                        },
-                        {  
-                            "$set": set_obj
-                        },
-                        upsert=True)
-        except Exception as e:
+        # repeated requests for a dsid that has not started training yet share one job,
+        # whichever worker process they reach
+        job_id = await self.trainer.submit(dsid, params, incremental, mfcc)
+        if not data.get('wait', False):
+            self.write_json({"status": "queued", "job_id": job_id, "dsid": dsid})
+            return
+
+        # the IOLoop keeps serving other clients while we wait
+        with self.timer('training'):
+            job = await self.trainer.wait(job_id)
+        if job is None or job["status"] == 'failed':
             self.set_status(400) #Bad request
-            self.write_json({"status":"Need > data"})
+            self.write_json({"status": job["error"] if job else "No training job found"})
             return
 
         # send back the resubstitution accuracy
-        # if training takes a while, we are blocking tornado!! No!!
+        f_res = {"status": "success", "job_id": job_id, "mode": job["mode"], "instances": job["instances"]}
+        for key in CLASSIFIERS:
+            if key in job:
+                f_res[key] = job[key]
         self.write_json(f_res)
 
-class PredictOne(BaseHandler):
+class TrainingStatus(BaseHandler):
     @tornado.web.authenticated
-    def post(self):
+    async def get(self):
+        '''Progress of a training job, by job_id or the latest one for a dsid,
+           run by any worker process
+        '''
+        self.set_header("Content-Type", "application/json")
+        job_id = self.get_argument("job_id", None)
+        if job_id is not None:
+            job = await self.trainer.status(job_id)
+        else:
+            try:
+                dsid = self.get_int_arg("dsid", default=None)
+            except HTTPJSONError:
+                self.set_status(400) #Bad request
+                self.write_json({"status":"invalid dsid"})
+                return
+            job = await self.trainer.latest(dsid)
+
+        if job is None:
+            self.set_status(404) #Not found
+            self.write_json({"status":"No training job found"})
+            return
+        self.write_json(job)
+
+class RecomputeFeatures(BaseHandler):
+    @tornado.web.authenticated
+    async def post(self):
+        '''Compute features of a dataset for other MFCC parameters from
+           the stored audio, in the background. Body: {"dsid":, "mfcc": {...}},
+           poll /FeatureStatus with the job_id or send "wait": true
+        '''
+        self.set_header("Content-Type", "application/json")
+        try:
+            data = json.loads(self.request.body.decode("utf-8"))
+            dsid = int(data['dsid'])
+            mfcc = mfcc_params(data['mfcc'])
+        except:
+            self.set_status(400) #Bad request
+            self.write_json({"status":"invalid request body"})
+            return
+
+        job_id = await self.features.submit(dsid, mfcc)
+        if data.get('wait', False):
+            job = await self.features.wait(job_id)
+        else:
+            job = await self.features.status(job_id)
+        if job is None:
+            self.set_status(404) #Not found
+            self.write_json({"status":"No feature job found"})
+            return
+        if job["status"] == 'failed':
+            self.set_status(400) #Bad request
+        self.write_json(job)
+
+class FeatureStatus(BaseHandler):
+    @tornado.web.authenticated
+    async def get(self):
+        '''Progress of a RecomputeFeatures job, run by any worker process
+        '''
+        self.set_header("Content-Type", "application/json")
+        job = await self.features.status(self.get_argument("job_id", ""))
+        if job is None:
+            self.set_status(404) #Not found
+            self.write_json({"status":"No feature job found"})
+            return
+        self.write_json(job)
+
+class PredictHandler(BaseHandler):
+    async def load_classifier(self, dsid, clf_name):
+        '''Fitted classifier for dsid, or None after writing the error response
+        '''
+        # load the model from the model store if we need to (memory-mapped)
+        # concurrent first requests for a dsid share one load, off the IOLoop
+        try:
+            with self.timer('load_model'):
+                models = await self.loader.get(dsid, self.timer)
+        except Exception as e:
+            print(e)
+            self.set_status(400) #Bad request
+            self.write_json({"status":"Could not load models for provided DSID"})
+            return None
+        if models is None:
+            self.set_status(400) #Bad request
+            self.write_json({"status":"No data found for provided DSID"})
+            return None
+        if not models.get(clf_name):
+            self.set_status(400) #Bad request
+            self.write_json({"status":"No records found for the provided classifier"})
+            return None
+        return models[clf_name]
+
+class PredictOne(PredictHandler):
+    @tornado.web.authenticated
+    async def post(self):
         '''Predict the class of a sent feature vector
         '''
         self.set_header("Content-Type", "application/json")
         try:
-            data = json.loads(self.request.body.decode("utf-8"))    
-            signal = list(data['signal'])
+            with self.timer('parse'):
+                data = self.get_signal_data(("sample_rate", "dsid", "clf_name"))
+                signal = np.asarray(data['signal'], dtype=MFCC_DTYPE)
+            if signal.ndim != 1:
+                raise ValueError("signal must be a list of samples")
             sample_rate = int(data['sample_rate'])
-            dsid  = int(data['dsid'])
+            dsid = self.dsid = int(data['dsid'])
             clf_name = data['clf_name']
         except:
             self.set_status(400) #Bad request
             self.write_json({"status":"invalid request body"})
             return
 
+        clf = await self.load_classifier(dsid, clf_name)
+        if clf is None:
+            return
+
+        # the same clip for the same model version was answered recently
+        version = self.loader.versions.get(dsid)
+        with self.timer('cache'):
+            key = self.predictions.key(signal, sample_rate, dsid, clf_name, version)
+            predLabel = self.predictions.get(key)
+        if predLabel is not None:
+            self.write_json({"status": "success", "predLabel":str(predLabel)})
+            return
+
+        #preprocess the audio, since we are only training the ML model on the mfcc transformation
+        with self.timer('scale'):
+            signal = signal * 10000
+        if not has_enough_data(clf, signal, sample_rate):
+            self.set_status(400) #Bad request
+            self.write_json({"status":"error processing audio"})
+            return
+
+        # featurized and predicted together with other requests for the same model,
+        # 'batch' includes waiting for the batch, the batch's mfcc and predict are added too
         try:
-            #preprocess the audio, since we are only training the ML model on the mfcc transformation
-            signal = [x*10000 for x in signal]
-            au = AudioUtility(signal=signal, sample_rate=sample_rate)
-            filt, mfcc = au.get_filter_mfcc() #model must be trained on default kwargs
-            finstance = mfcc.reshape(1,-1) 
+            with self.timer('batch'):
+                predLabel = await self.batcher.predict((dsid, clf_name, sample_rate, version), clf, signal, self.timer)
         except:
             self.set_status(400) #Bad request
             self.write_json({"status":"error processing audio"})
             return
-        
+        if self.loader.versions.get(dsid) == version: # not retrained meanwhile
+            self.predictions.put(key, predLabel)
+        self.write_json({"status": "success", "predLabel":str(predLabel)})
+
+class PredictBatch(PredictHandler):
+    @tornado.web.authenticated
+    async def post(self):
+        '''Predict the classes of many signals in one request
+           JSON: {"signals": [[...], ...], "sample_rate":, "dsid":, "clf_name":}
+           binary: equal length signals back to back, with a count argument
+        '''
+        self.set_header("Content-Type", "application/json")
+        try:
+            with self.timer('parse'):
+                data = self.get_signal_data(("sample_rate", "dsid", "clf_name", "count"))
+                if 'signals' in data:
+                    signals = [np.asarray(signal, dtype=MFCC_DTYPE) * 10000 for signal in data['signals']]
+                else:
+                    signals = np.asarray(data['signal'], dtype=MFCC_DTYPE).reshape(int(data['count']), -1) * 10000
+            if not len(signals) or any(signal.ndim != 1 for signal in signals):
+                raise ValueError("signals must be lists of samples")
+            sample_rate = int(data['sample_rate'])
+            dsid = self.dsid = int(data['dsid'])
+            clf_name = data['clf_name']
+        except:
+            self.set_status(400) #Bad request
+            self.write_json({"status":"invalid request body"})
+            return
+
+        clf = await self.load_classifier(dsid, clf_name)
+        if clf is None:
+            return
 
-        # load the model from the database if we need to (using pickle)
-        # we are blocking tornado!! no!!
-        if dsid not in self.models:
-            self.models[dsid] = {}
-            tmp = self.db.models.find_one({"dsid":dsid})
-            if not tmp:
+        for signal in signals:
+            if not has_enough_data(clf, signal, sample_rate):
                 self.set_status(400) #Bad request
-                self.write_json({"status":"No data found for provided DSID"})
+                self.write_json({"status":"error processing audio"})
                 return
-            for key in tmp.keys():
-                if '_model' in key:
-                    self.models[dsid][key[:-6]] = pickle.loads(tmp[key])
-        if not self.models[dsid][clf_name]:
+
+        try:
+            predLabels = await IOLoop.current().run_in_executor(None, predict_signals, clf, signals, sample_rate, self.timer)
+        except:
             self.set_status(400) #Bad request
-            self.write_json({"status":"No records found for the provided classifier"})
+            self.write_json({"status":"error processing audio"})
             return
-        predLabel = self.models[dsid][clf_name].predict(finstance)[0]
-        self.write_json({"status": "success", "predLabel":str(predLabel)})
+        self.write_json({"status": "success", "predLabels":[str(label) for label in predLabels]})
+
+class PredictStream(tornado.websocket.WebSocketHandler, BaseHandler):
+    '''Predict from audio sent in chunks over a WebSocket, e.g.
+           /PredictStream?dsid=1&clf_name=knn&sample_rate=16000&format=int16
+       Binary messages are raw PCM (format float32 or int16), text messages
+       JSON {"signal": [...]}. Frames are featurized as the chunks arrive,
+       {"status": "success", "predLabel":, "clip":} goes out as soon as a
+       clip is complete and the audio after it starts the next clip
+    '''
+    async def open(self):
+        self.stream = None # set once the stream is ready for audio
+        if not self.current_user:
+            self.close(1008, "login required")
+            return
+        try:
+            dsid = int(self.get_argument("dsid"))
+            clf_name = self.get_argument("clf_name")
+            sample_rate = int(self.get_argument("sample_rate"))
+            self.sample_format = self.get_argument("format", "float32")
+        except Exception:
+            self.fail("invalid request arguments")
+            return
+
+        try:
+            models = await self.loader.get(dsid)
+        except Exception as e:
+            print(e)
+            models = None
+        if not models or not models.get(clf_name):
+            self.fail("No records found for the provided DSID and classifier")
+            return
+        self.classifier = models[clf_name]
+        try:
+            # the frames are computed the way the model's training data was
+            self.plan = get_mfcc_plan(sample_rate, dtype=np.dtype(MFCC_DTYPE), **getattr(self.classifier, 'mfcc_params_', {}))
+            self.stream = MfccStream(self.plan)
+        except Exception:
+            self.fail("invalid sample_rate")
+            return
+        self.clips = 0
+
+    async def on_message(self, message):
+        if self.stream is None:
+            return # open() failed and is hanging up
+        try:
+            if isinstance(message, bytes):
+                signal = decode_pcm(message, self.sample_format)
+            else:
+                signal = np.asarray(json.loads(message)['signal'], dtype=MFCC_DTYPE)
+            if signal.ndim != 1:
+                raise ValueError("signal must be a list of samples")
+        except Exception:
+            self.fail("invalid audio chunk")
+            return
+
+        #preprocess the audio, since we are only training the ML model on the mfcc transformation
+        signal = signal * 10000
+        while len(signal):
+            signal = self.stream.feed(signal)
+            if not self.stream.complete:
+                break
+            filter_banks, mfcc = self.stream.result()
+            self.stream = MfccStream(self.plan)
+            self.clips += 1
+            predLabel = await IOLoop.current().run_in_executor(None, self.classifier.predict, mfcc.reshape(1, -1))
+            self.write_message(json_str({"status": "success", "predLabel": str(predLabel[0]), "clip": self.clips}))
+
+    def fail(self, status):
+        '''Send the error to the client and hang up'''
+        self.write_message(json_str({"status": status}))
+        self.close(1003, status)
+
+class ModelCacheStats(BaseHandler):
+    @tornado.web.authenticated
+    def get(self):
+        '''Size and hit/miss/eviction counters of the in-memory model cache
+           of the worker process that answers
+        '''
+        self.write_json(dict(self.models.stats(), worker=worker_name()))
+
+class MetricsHandler(BaseHandler):
+    def get(self):
+        '''Stage latency histograms and cache counters in the Prometheus
+           text format, of the worker process that answers (labeled with
+           it). Not behind the login so scrapers can read it
+        '''
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(self.application.metrics.render())
+
+class SlowRequests(BaseHandler):
+    @tornado.web.authenticated
+    def get(self):
+        '''Stage timings and most sampled stacks of recent slow requests
+           served by the worker process that answers
+        '''
+        profiler = self.application.profiler
+        self.write_json({"threshold_ms": 1000 * profiler.threshold, "worker": worker_name(), "requests": list(profiler.slow)})
+
+    @tornado.web.authenticated
+    def post(self):
+        '''Turn the profiler on for requests slower than {"threshold_ms": N},
+           0 turns it off
+        '''
+        try:
+            data = json.loads(self.request.body.decode("utf-8"))
+            threshold = float(data['threshold_ms']) / 1000
+        except:
+            self.set_status(400) #Bad request
+            self.write_json({"status":"invalid request body"})
+            return
+        self.application.profiler.set_threshold(threshold)
+        self.write_json({"status": "success", "threshold_ms": 1000 * threshold})
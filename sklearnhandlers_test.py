@@ -0,0 +1,397 @@
+import io
+import json
+import pickle
+import tarfile
+import tempfile
+
+import numpy as np
+import pytest
+import scipy.io.wavfile
+from tornado import gen, httpclient, websocket
+from tornado.options import options
+from tornado.testing import AsyncHTTPTestCase
+
+mongomock = pytest.importorskip("mongomock")
+import mongomock.gridfs
+mongomock.gridfs.enable_gridfs_integration()
+
+from jobs import worker_name
+from tornado_scikit_learn import Application
+from training import TrainingJob
+
+SAMPLE_RATE = 8000
+
+
+def tone(freq, seconds=3.6):
+    t = np.arange(int(SAMPLE_RATE * seconds)) / float(SAMPLE_RATE)
+    return (0.3 * np.sin(2 * np.pi * freq * t * (1 + t))).astype(np.float32)
+
+
+class SklearnHandlersTest(AsyncHTTPTestCase):
+    def get_app(self):
+        options.train_executor = "thread"
+        options.model_dir = tempfile.mkdtemp()
+        return Application(client=mongomock.MongoClient())
+
+    def setUp(self):
+        super(SklearnHandlersTest, self).setUp()
+        response = self.fetch("/Login", method="POST", body=json.dumps({"username": "user", "password": "pass"}))
+        self.cookie = response.headers["Set-Cookie"].split(";")[0]
+
+    def post(self, path, body, headers={}):
+        headers = dict(headers, Cookie=self.cookie)
+        response = self.fetch(path, method="POST", body=body, headers=headers)
+        return response.code, json.loads(response.body.decode("utf-8"))
+
+    def get(self, path):
+        response = self.fetch(path, headers={"Cookie": self.cookie})
+        return response.code, json.loads(response.body.decode("utf-8"))
+
+    def add_dataset(self, dsid):
+        for i in range(3):
+            for label, freq in (("low", 200), ("high", 1500)):
+                body = {"signal": tone(freq + 20 * i).tolist(), "sample_rate": SAMPLE_RATE, "label": label, "dsid": dsid}
+                self.assertEqual(self.post("/AddDataPoint", json.dumps(body))[0], 200)
+
+    def test_train_and_predict(self):
+        self.add_dataset(1)
+        code, res = self.post("/UpdateModel", json.dumps({"dsid": 1, "knn": {"n_neighbors": 1}, "svm": {}, "wait": True}))
+        self.assertEqual((code, res["knn"]), (200, "1.0"))
+        self.assertEqual(self.get("/TrainingStatus?job_id=" + res["job_id"])[1]["status"], "done")
+
+        # binary float32 body, metadata in the query string
+        code, res = self.post("/PredictOne?sample_rate=%d&dsid=1&clf_name=knn" % SAMPLE_RATE, tone(1500).tobytes(),
+                              headers={"Content-Type": "application/octet-stream"})
+        self.assertEqual((code, res["predLabel"]), (200, "high"))
+
+    def test_update_needs_two_labels(self):
+        code, res = self.post("/UpdateModel", json.dumps({"dsid": 5, "knn": {}, "svm": {}, "wait": True}))
+        self.assertEqual((code, res["status"]), (400, "Need > class labels"))
+
+    def test_update_rejects_bad_classifier_params(self):
+        for body, message in (({"dsid": 5, "knn": {"backend": "x"}}, "invalid knn parameters: Unknown knn backend x"),
+                              ({"dsid": 5, "svm": {"no_such_kwarg": 1}}, "invalid svm parameters")):
+            code, res = self.post("/UpdateModel", json.dumps(body))
+            self.assertEqual(code, 400)
+            self.assertTrue(res["status"].startswith(message), res)
+        self.assertEqual(self.get("/TrainingStatus?dsid=abc"), (400, {"status": "invalid dsid"}))
+
+    def test_short_signal_rejected(self):
+        body = {"signal": [0.0] * 100, "sample_rate": SAMPLE_RATE, "label": "x", "dsid": 1}
+        self.assertEqual(self.post("/AddDataPoint", json.dumps(body))[0], 400)
+
+    def test_concurrent_cold_predictions_share_one_load(self):
+        self.add_dataset(2)
+        self.post("/UpdateModel", json.dumps({"dsid": 2, "knn": {"n_neighbors": 1}, "svm": {}, "wait": True}))
+        loader = self._app.loader
+        loader.models.pop(2)
+        loads = []
+        load = loader._load
+        loader._load = lambda dsid, timer: loads.append(dsid) or load(dsid, timer)
+
+        body = json.dumps({"signal": tone(200).tolist(), "sample_rate": SAMPLE_RATE, "dsid": 2, "clf_name": "svm"})
+        futures = [self.http_client.fetch(self.get_url("/PredictOne"), method="POST", body=body, headers={"Cookie": self.cookie})
+                   for _ in range(4)]
+        responses = self.io_loop.run_sync(lambda: gen.multi(futures))
+        self.assertEqual([r.code for r in responses], [200] * 4)
+        self.assertEqual(loads, [2])
+        self.assertIn(2, loader.models)
+
+    def test_predict_batch(self):
+        self.add_dataset(3)
+        self.post("/UpdateModel", json.dumps({"dsid": 3, "knn": {"n_neighbors": 1}, "svm": {}, "wait": True}))
+        signals = [tone(1500), tone(200), tone(1520)]
+        body = {"signals": [s.tolist() for s in signals], "sample_rate": SAMPLE_RATE, "dsid": 3, "clf_name": "knn"}
+        code, res = self.post("/PredictBatch", json.dumps(body))
+        self.assertEqual((code, res["predLabels"]), (200, ["high", "low", "high"]))
+
+        code, res = self.post("/PredictBatch?sample_rate=%d&dsid=3&clf_name=knn&count=3" % SAMPLE_RATE,
+                              np.concatenate(signals).tobytes(), headers={"Content-Type": "application/octet-stream"})
+        self.assertEqual((code, res["predLabels"]), (200, ["high", "low", "high"]))
+
+    def test_binary_features_mixed_and_migrated(self):
+        from dataset import decode_feature, migrate_features
+        instances = self._app.client.sklearndatabase.labeledinstances
+        self.add_dataset(16) # array features
+        self._app.settings['binary_features'] = True
+        try:
+            body = {"signal": tone(1540).tolist(), "sample_rate": SAMPLE_RATE, "label": "high", "dsid": 16}
+            self.assertEqual(self.post("/AddDataPoint", json.dumps(body))[0], 200)
+        finally:
+            self._app.settings['binary_features'] = False
+        self.assertEqual(instances.count_documents({"dsid": 16, "feature": {"$type": "array"}}), 6)
+        blob = instances.find_one({"dsid": 16, "feature_dtype": {"$exists": True}})
+        self.assertEqual(len(decode_feature(blob)), len(instances.find_one({"dsid": 16})["feature"]))
+
+        # trains and predicts on a dataset holding both formats
+        code, res = self.post("/UpdateModel", json.dumps({"dsid": 16, "knn": {"n_neighbors": 1}, "wait": True}))
+        self.assertEqual((code, res["status"], res["instances"]), (200, "success", 7))
+        body = json.dumps({"signal": tone(1540).tolist(), "sample_rate": SAMPLE_RATE, "dsid": 16, "clf_name": "knn"})
+        self.assertEqual(self.post("/PredictOne", body)[1]["predLabel"], "high")
+
+        # migrating rewrites the same values as float32 blobs
+        before = {doc["_id"]: np.asarray(doc["feature"], dtype=np.float32) for doc in instances.find({"dsid": 16, "feature": {"$type": "array"}})}
+        self.assertEqual(migrate_features(instances, 16), 6)
+        self.assertEqual(instances.count_documents({"dsid": 16, "feature": {"$type": "array"}}), 0)
+        for _id, feature in before.items():
+            np.testing.assert_array_equal(decode_feature(instances.find_one({"_id": _id})), feature)
+        self.assertEqual(migrate_features(instances, 16), 0)
+
+        self.post("/UpdateModel", json.dumps({"dsid": 16, "knn": {"n_neighbors": 1}, "wait": True}))
+        self.assertEqual(self.post("/PredictOne", body)[1]["predLabel"], "high")
+
+    def test_predict_rejects_bad_bodies(self):
+        self.add_dataset(14)
+        self.post("/UpdateModel", json.dumps({"dsid": 14, "knn": {"n_neighbors": 1}, "wait": True}))
+        for signals in ([], [5.0], [[5.0], 5.0]):
+            body = {"signals": signals, "sample_rate": SAMPLE_RATE, "dsid": 14, "clf_name": "knn"}
+            self.assertEqual(self.post("/PredictBatch", json.dumps(body)), (400, {"status": "invalid request body"}))
+        body = {"signal": 5.0, "sample_rate": SAMPLE_RATE, "dsid": 14, "clf_name": "knn"}
+        self.assertEqual(self.post("/PredictOne", json.dumps(body)), (400, {"status": "invalid request body"}))
+        for sample_rate in (0, 5):
+            body = {"signals": [tone(1500).tolist()], "sample_rate": sample_rate, "dsid": 14, "clf_name": "knn"}
+            self.assertEqual(self.post("/PredictBatch", json.dumps(body)), (400, {"status": "error processing audio"}))
+
+    def test_incremental_update_only_fits_new_instances(self):
+        self.add_dataset(4)
+        update = {"dsid": 4, "knn": {"n_neighbors": 1}, "sgd": {"random_state": 0}, "wait": True, "incremental": True}
+        code, res = self.post("/UpdateModel", json.dumps(update))
+        self.assertEqual((code, res["mode"], res["instances"]), (200, "full", 6))
+
+        body = {"signal": tone(900).tolist(), "sample_rate": SAMPLE_RATE, "label": "mid", "dsid": 4}
+        self.post("/AddDataPoint", json.dumps(body))
+        body["label"] = "high"
+        self.post("/AddDataPoint", json.dumps(body))
+        # a label sgd has never seen forces a full refit
+        code, res = self.post("/UpdateModel", json.dumps(update))
+        self.assertEqual((code, res["mode"], res["instances"]), (200, "full", 8))
+
+        self.post("/AddDataPoint", json.dumps(body))
+        code, res = self.post("/UpdateModel", json.dumps(update))
+        self.assertEqual((code, res["mode"], res["instances"]), (200, "incremental", 1))
+        self.assertEqual(self._app.loader.models.get(4)["knn"]._fit_X.shape[0], 9)
+
+        # changed hyperparameters refit everything
+        update["knn"] = {"n_neighbors": 3}
+        code, res = self.post("/UpdateModel", json.dumps(update))
+        self.assertEqual((code, res["mode"], res["instances"]), (200, "full", 9))
+
+    def test_knn_backend_from_params(self):
+        self.add_dataset(6)
+        update = {"dsid": 6, "knn": {"n_neighbors": 1, "backend": "pca", "n_components": 4}, "wait": True, "incremental": True}
+        self.assertEqual(self.post("/UpdateModel", json.dumps(update))[0], 200)
+        body = {"signal": tone(1540).tolist(), "sample_rate": SAMPLE_RATE, "label": "high", "dsid": 6}
+        self.post("/AddDataPoint", json.dumps(body))
+        code, res = self.post("/UpdateModel", json.dumps(update))
+        self.assertEqual((code, res["mode"]), (200, "incremental"))
+
+        body = {"signal": tone(200).tolist(), "sample_rate": SAMPLE_RATE, "dsid": 6, "clf_name": "knn"}
+        self.assertEqual(self.post("/PredictOne", json.dumps(body))[1]["predLabel"], "low")
+
+    def test_models_stored_out_of_document(self):
+        self.add_dataset(7)
+        self.post("/UpdateModel", json.dumps({"dsid": 7, "knn": {"n_neighbors": 1}, "wait": True}))
+        doc = self._app.client.sklearndatabase.models.find_one({"dsid": 7})
+        self.assertEqual((doc["version"], "knn_model" in doc), (1, False))
+
+        # a cold load maps the training set from the local file
+        self._app.loader.models.pop(7)
+        body = {"signal": tone(200).tolist(), "sample_rate": SAMPLE_RATE, "dsid": 7, "clf_name": "knn"}
+        self.assertEqual(self.post("/PredictOne", json.dumps(body))[1]["predLabel"], "low")
+        self.assertIsInstance(self._app.loader.models.get(7)["knn"]._fit_X, np.memmap)
+
+        # models pickled into the document before the store still load
+        knn = self._app.loader.models.pop(7)["knn"]
+        self._app.client.sklearndatabase.models.replace_one({"dsid": 7}, {"dsid": 7, "knn_model": pickle.dumps(knn)})
+        self.assertEqual(self.post("/PredictOne", json.dumps(body))[1]["predLabel"], "low")
+
+    def test_train_on_recomputed_features(self):
+        self.add_dataset(8)
+        mfcc = {"nfilt": 26, "num_ceps": 8, "subsample_length": 3.0}
+        code, res = self.post("/RecomputeFeatures", json.dumps({"dsid": 8, "mfcc": mfcc, "wait": True}))
+        self.assertEqual((code, res["status"], res["computed"], res["skipped"]), (200, "done", 6, 0))
+
+        code, res = self.post("/UpdateModel", json.dumps({"dsid": 8, "knn": {"n_neighbors": 1}, "mfcc": mfcc, "wait": True}))
+        self.assertEqual((code, res["instances"]), (200, 6))
+        self._app.loader.models.pop(8)
+        # 3.2s is too short for the default features, enough for these
+        body = {"signal": tone(200, seconds=3.2).tolist(), "sample_rate": SAMPLE_RATE, "dsid": 8, "clf_name": "knn"}
+        self.assertEqual(self.post("/PredictOne", json.dumps(body))[1]["predLabel"], "low")
+        self.assertEqual(self._app.loader.models.get(8)["knn"]._fit_X.shape, (6, 298 * 8))
+
+    def test_predict_stream(self):
+        self.add_dataset(9)
+        self.post("/UpdateModel", json.dumps({"dsid": 9, "knn": {"n_neighbors": 1}, "wait": True}))
+        url = self.get_url("/PredictStream?dsid=9&clf_name=knn&sample_rate=%d" % SAMPLE_RATE).replace("http", "ws", 1)
+
+        async def stream():
+            conn = await websocket.websocket_connect(httpclient.HTTPRequest(url, headers={"Cookie": self.cookie}))
+            # two clips back to back, in chunks that do not line up with frames or clips
+            audio = np.concatenate((tone(1500), tone(200)))
+            for start in range(0, len(audio), 3001):
+                conn.write_message(audio[start:start + 3001].tobytes(), binary=True)
+            res = [json.loads(await conn.read_message()) for _ in range(2)]
+            conn.close()
+            return res
+
+        res = self.io_loop.run_sync(stream)
+        self.assertEqual([(r["predLabel"], r["clip"]) for r in res], [("high", 1), ("low", 2)])
+
+    def test_predict_stream_rejects_bad_arguments(self):
+        self.add_dataset(15)
+        self.post("/UpdateModel", json.dumps({"dsid": 15, "knn": {"n_neighbors": 1}, "wait": True}))
+
+        async def status(query):
+            url = self.get_url("/PredictStream?" + query).replace("http", "ws", 1)
+            conn = await websocket.websocket_connect(httpclient.HTTPRequest(url, headers={"Cookie": self.cookie}))
+            res = json.loads(await conn.read_message())["status"]
+            self.assertIsNone(await conn.read_message()) # and hung up
+            return res
+
+        async def chunk(message):
+            url = self.get_url("/PredictStream?dsid=15&clf_name=knn&sample_rate=%d" % SAMPLE_RATE).replace("http", "ws", 1)
+            conn = await websocket.websocket_connect(httpclient.HTTPRequest(url, headers={"Cookie": self.cookie}))
+            conn.write_message(message)
+            res = json.loads(await conn.read_message())["status"]
+            self.assertIsNone(await conn.read_message())
+            return res
+
+        self.assertEqual(self.io_loop.run_sync(lambda: chunk(json.dumps({"signal": 5}))), "invalid audio chunk")
+
+        for query, expected in (("dsid=15&clf_name=knn", "invalid request arguments"),
+                                ("clf_name=knn&sample_rate=8000", "invalid request arguments"),
+                                ("dsid=15&clf_name=knn&sample_rate=0", "invalid sample_rate")):
+            self.assertEqual(self.io_loop.run_sync(lambda: status(query)), expected)
+
+    def test_import_dataset(self):
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+            for i, (label, freq) in enumerate((("low", 200), ("high", 1500)) * 3):
+                wav = io.BytesIO()
+                scipy.io.wavfile.write(wav, SAMPLE_RATE, (tone(freq + 10 * i) * 32767).astype(np.int16))
+                info = tarfile.TarInfo("clips/%s/%d.wav" % (label, i))
+                info.size = len(wav.getvalue())
+                tar.addfile(info, io.BytesIO(wav.getvalue()))
+        code, res = self.post("/ImportDataset?dsid=10", archive.getvalue(), headers={"Content-Type": "application/gzip"})
+        self.assertEqual((code, res["clips"], res["instances"], res["failed"]), (200, 6, 6, []))
+
+        code, res = self.post("/UpdateModel", json.dumps({"dsid": 10, "knn": {"n_neighbors": 1}, "wait": True}))
+        self.assertEqual((code, res["knn"]), (200, "1.0"))
+        body = {"signal": tone(1500).tolist(), "sample_rate": SAMPLE_RATE, "dsid": 10, "clf_name": "knn"}
+        self.assertEqual(self.post("/PredictOne", json.dumps(body))[1]["predLabel"], "high")
+
+    def test_import_multipart_labels(self):
+        wav = io.BytesIO()
+        scipy.io.wavfile.write(wav, SAMPLE_RATE, (tone(200) * 32767).astype(np.int16))
+        body = (b'--xx\r\nContent-Disposition: form-data; name="low"; filename="a.wav"\r\n'
+                b'Content-Type: audio/wav\r\n\r\n' + wav.getvalue() + b'\r\n--xx--\r\n')
+        headers = {"Content-Type": "multipart/form-data; boundary=xx"}
+        instances = self._app.client.sklearndatabase.labeledinstances
+        # the field name when no label is given, an explicit label wins over it
+        for dsid, query, label in ((18, "", "low"), (19, "&label=speech", "speech")):
+            code, res = self.post("/ImportDataset?dsid=%d%s" % (dsid, query), body, headers=headers)
+            self.assertEqual((code, res["instances"]), (200, 1))
+            self.assertEqual(instances.distinct("label", {"dsid": dsid}), [label])
+
+    def test_metrics_and_slow_requests(self):
+        self.add_dataset(11)
+        self.post("/UpdateModel", json.dumps({"dsid": 11, "knn": {"n_neighbors": 1}, "wait": True}))
+        self._app.loader.models.pop(11)
+        self.assertEqual(self.post("/SlowRequests", json.dumps({"threshold_ms": 0.001}))[0], 200)
+        body = {"signal": tone(200).tolist(), "sample_rate": SAMPLE_RATE, "dsid": 11, "clf_name": "knn"}
+        self.post("/PredictOne", json.dumps(body))
+
+        text = self.fetch("/metrics").body.decode("utf-8")
+        worker = 'worker="%s"' % worker_name()
+        for stage in ("parse", "load_model", "db_lookup", "deserialize", "scale", "batch", "mfcc", "predict", "total"):
+            self.assertIn('sklearn_request_stage_seconds_count{%s,endpoint="PredictOne",stage="%s",dsid="11"} 1' % (worker, stage), text)
+        self.assertIn('sklearn_request_stage_seconds_count{%s,endpoint="UploadLabeledDatapointHandler",stage="mfcc",dsid="11"} 6' % worker, text)
+        self.assertIn('sklearn_model_cache_misses_total{%s}' % worker, text)
+
+        slow = self.get("/SlowRequests")[1]["requests"]
+        self.assertIn("PredictOne", [r["endpoint"] for r in slow])
+        self.post("/SlowRequests", json.dumps({"threshold_ms": 0}))
+
+    def test_jobs_are_shared_between_workers(self):
+        # a second worker process: same database, its own queues
+        other = Application(client=self._app.client)
+        self.add_dataset(17)
+        # the other worker is busy training dsid 17
+        blocker = TrainingJob(17, {"knn": {}})
+        blocker.status = 'training'
+        self.io_loop.run_sync(lambda: other.trainer.board.publish(blocker))
+        self.io_loop.run_sync(lambda: other.trainer.board.claim("training:17", "running", blocker.job_id))
+        code, res = self.post("/UpdateModel", json.dumps({"dsid": 17, "knn": {"n_neighbors": 1}}))
+        job_id = res["job_id"]
+        self.assertEqual(self.get("/TrainingStatus?dsid=17")[1]["status"], "queued")
+
+        # a retrain reaching the other worker while ours is still queued joins it, latest params win
+        joined = self.io_loop.run_sync(lambda: other.trainer.submit(17, {"knn": {"n_neighbors": 3}}))
+        self.assertEqual(joined, job_id)
+        blocker.status = 'done'
+        self.io_loop.run_sync(lambda: other.trainer.board.publish(blocker))
+        self.io_loop.run_sync(lambda: other.trainer.board.release("training:17", "running", blocker.job_id))
+
+        # the other worker waits for and reports on a job only we run
+        status = self.io_loop.run_sync(lambda: other.trainer.wait(job_id))
+        self.assertEqual((status["status"], status["params"], status["worker"]), ("done", {"knn": {"n_neighbors": 3}}, worker_name()))
+        self.assertEqual(self.io_loop.run_sync(lambda: other.trainer.status(job_id))["instances"], 6)
+        self.assertEqual(self.io_loop.run_sync(lambda: other.trainer.latest(17))["job_id"], job_id)
+        self.assertEqual(self._app.loader.models.get(17)["knn"].n_neighbors, 3)
+
+        # and the same for feature jobs
+        mfcc = {"nfilt": 20}
+        feature_job = self.io_loop.run_sync(lambda: other.features.submit(17, mfcc))
+        self.assertEqual(self.io_loop.run_sync(lambda: self._app.features.wait(feature_job))["computed"], 6)
+        self.assertEqual(self.get("/FeatureStatus?job_id=" + feature_job)[1]["status"], "done")
+        # finished jobs free their lock, the next one starts fresh
+        self.assertNotEqual(self.io_loop.run_sync(lambda: other.features.submit(17, mfcc)), feature_job)
+
+    def test_worker_drops_models_retrained_by_another(self):
+        # a second worker process: same database and model files, its own cache
+        other = Application(client=self._app.client)
+        self.add_dataset(12)
+        self.post("/UpdateModel", json.dumps({"dsid": 12, "knn": {"n_neighbors": 1}, "wait": True}))
+        knn = self.io_loop.run_sync(lambda: other.loader.get(12))["knn"]
+        self.assertEqual(self.io_loop.run_sync(other.loader.refresh), [])
+
+        self.post("/UpdateModel", json.dumps({"dsid": 12, "knn": {"n_neighbors": 3}, "wait": True}))
+        self.assertEqual(self.io_loop.run_sync(other.loader.refresh), [12])
+        self.assertEqual(self.io_loop.run_sync(lambda: other.loader.get(12))["knn"].n_neighbors, 3)
+        # the replaced model stays usable from its mapping
+        self.assertEqual(len(knn.predict(knn._fit_X[:1])), 1)
+
+    def test_new_dataset_ids_follow_existing(self):
+        self.add_dataset(7)
+        ids = [self.get("/GetNewDatasetId")[1]["dsid"] for _ in range(3)]
+        self.assertEqual(ids, [8, 9, 10])
+
+        # a client picking its own dsid ahead of the counter
+        instances = self._app.client.sklearndatabase.labeledinstances
+        instances.insert_one({"dsid": 12, "label": "x", "feature": []})
+        ids = [self.get("/GetNewDatasetId")[1]["dsid"] for _ in range(3)]
+        self.assertEqual(ids, [11, 13, 14])
+
+    def test_repeated_prediction_is_cached_until_retrained(self):
+        self.add_dataset(13)
+        self.post("/UpdateModel", json.dumps({"dsid": 13, "knn": {"n_neighbors": 1}, "wait": True}))
+        body = json.dumps({"signal": tone(1500).tolist(), "sample_rate": SAMPLE_RATE, "dsid": 13, "clf_name": "knn"})
+        predictions = self._app.predictions
+        for _ in range(3):
+            self.assertEqual(self.post("/PredictOne", body)[1]["predLabel"], "high")
+        self.assertEqual((predictions.hits, len(predictions)), (2, 1))
+
+        # the same clip as raw float32 has the same key
+        self.post("/PredictOne?sample_rate=%d&dsid=13&clf_name=knn" % SAMPLE_RATE, tone(1500).tobytes(),
+                  headers={"Content-Type": "application/octet-stream"})
+        self.assertEqual(predictions.hits, 3)
+
+        # evicted and loaded again at the same version, the predictions still hold
+        self._app.loader.models.pop(13)
+        self.assertEqual(self.post("/PredictOne", body)[1]["predLabel"], "high")
+        self.assertEqual((predictions.hits, len(predictions)), (4, 1))
+
+        self.post("/UpdateModel", json.dumps({"dsid": 13, "knn": {"n_neighbors": 3}, "wait": True}))
+        self.assertEqual(len(predictions), 0)
+        self.assertEqual(self.post("/PredictOne", body)[1]["predLabel"], "high")
+        self.assertEqual(predictions.hits, 4)
@@ -7,8 +7,14 @@
 #    might need to use sudo (yikes!)
 
 # database imports
+from concurrent.futures import ThreadPoolExecutor
+import os
+import tempfile
 from pymongo import MongoClient
 from pymongo.errors import ServerSelectionTimeoutError
+from asyncdb import AsyncDatabase
+from dataset import ensure_indexes
+from jobs import ensure_job_indexes
 
 
 # tornado imports
@@ -16,24 +22,53 @@ import tornado.web
 from tornado.web import HTTPError
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+import tornado.process
 from tornado.options import define, options
 
 # custom imports
 from basehandler import BaseHandler
 import sklearnhandlers as skh
 import handlers as hd
+from training import TrainingQueue, make_executor
+from modelcache import ModelCache, ModelLoader, PredictionCache
+from modelstore import ModelStore
+from batching import MicroBatcher
+from features import FeatureQueue
+from metrics import Metrics, SlowRequestProfiler
 
 # Setup information for tornado class
 define("port", default=80, help="run on the given port", type=int)
+define("processes", default=1, help="worker processes sharing the port, 0 for one per CPU", type=int)
+define("model_poll_s", default=2.0, help="how often workers check db.models for dsids retrained elsewhere (0 is never)", type=float)
+define("train_executor", default="process", help="pool models are fitted in (process or thread)", type=str)
+define("train_workers", default=2, help="number of training workers", type=int)
+define("incremental_training", default=False, help="UpdateModel only fits new instances unless asked otherwise", type=bool)
+define("import_workers", default=2, help="workers featurizing ImportDataset uploads (same kind as train_executor)", type=int)
+define("db_workers", default=8, help="threads used for database round-trips", type=int)
+define("binary_features", default=False, help="store new features as float32 blobs (see dataset.py migrate)", type=bool)
+define("store_audio", default=True, help="keep the audio of new instances so features can be recomputed with other mfcc parameters", type=bool)
+define("model_cache_entries", default=64, help="most dsids kept in memory", type=int)
+define("model_cache_mb", default=512, help="memory budget for cached models, in MB", type=int)
+define("model_dir", default=os.path.join(tempfile.gettempdir(), "sklearn_models"), help="local copies of stored models, memory-mapped when loaded", type=str)
+define("model_compress", default=0, help="compression level (0-9) of stored models, compressed models are not memory-mapped", type=int)
+define("prediction_cache_entries", default=10000, help="most recent PredictOne results kept per worker (0 is off)", type=int)
+define("prediction_cache_ttl_s", default=300.0, help="how long a cached PredictOne result is served", type=float)
+define("warm_models", default=0, help="preload models of this many recently trained dsids at startup", type=int)
+define("profile_slow_ms", default=0, help="sample stacks and keep profiles of requests slower than this (0 is off, see /SlowRequests)", type=float)
+define("batch_window_ms", default=2.0, help="how long PredictOne waits to batch with other requests for the same model", type=float)
+define("max_batch", default=32, help="most PredictOne requests featurized and predicted together", type=int)
 
 # Utility to be used when creating the Tornado server
 # Contains the handlers and the database connection
 class Application(tornado.web.Application):
-    def __init__(self):
+    def __init__(self, client=None):
         '''Store necessary handlers,
-           connect to database
+           connect to database (or use client, e.g. a mongomock.MongoClient)
         '''
-        models = {}
+        # least recently used dsids are dropped once the budget is exceeded
+        models = ModelCache(max_entries=options.model_cache_entries,
+                            max_bytes=options.model_cache_mb * 1024 * 1024)
         # format for above object ^
         # {
         #     dsidX: {
@@ -47,9 +82,18 @@ class Application(tornado.web.Application):
         handlers = [(r"/[/]?", BaseHandler),
                     (r"/Handlers[/]?",        skh.PrintHandlers,                 dict(models=models)),
                     (r"/AddDataPoint[/]?",    skh.UploadLabeledDatapointHandler, dict(models=models)),
+                    (r"/ImportDataset[/]?",   skh.ImportDataset,                 dict(models=models)),
                     (r"/GetNewDatasetId[/]?", skh.RequestNewDatasetId,           dict(models=models)),
                     (r"/UpdateModel[/]?",     skh.UpdateModel,                   dict(models=models)),     
+                    (r"/TrainingStatus[/]?",  skh.TrainingStatus,                dict(models=models)),
+                    (r"/RecomputeFeatures[/]?", skh.RecomputeFeatures,           dict(models=models)),
+                    (r"/FeatureStatus[/]?",   skh.FeatureStatus,                 dict(models=models)),
                     (r"/PredictOne[/]?",      skh.PredictOne,                    dict(models=models)),    
+                    (r"/PredictBatch[/]?",    skh.PredictBatch,                  dict(models=models)),
+                    (r"/PredictStream[/]?",   skh.PredictStream,                 dict(models=models)),
+                    (r"/ModelCacheStats[/]?", skh.ModelCacheStats,               dict(models=models)),
+                    (r"/metrics",             skh.MetricsHandler,                dict(models=models)),
+                    (r"/SlowRequests[/]?",    skh.SlowRequests,                  dict(models=models)),
                     (r"/Login[/]?",           hd.LoginHandler,                   dict(models=models)),
                     (r"/Logout[/]?",          hd.LogoutHandler,                  dict(models=models)),          
                     ]
@@ -57,19 +101,52 @@ class Application(tornado.web.Application):
         self.handlers_string = str(handlers)
 
         try:
-            self.client  = MongoClient(serverSelectionTimeoutMS=50) # local host, default port
-            print(self.client.server_info()) # force pymongo to look for possible running servers, error if none running
+            if client is None:
+                client = MongoClient(serverSelectionTimeoutMS=50) # local host, default port
+                print(client.server_info()) # force pymongo to look for possible running servers, error if none running
             # if we get here, at least one instance of pymongo is running
-            self.db = self.client.sklearndatabase # database with labeledinstances, models
+            self.client = client
+            ensure_indexes(self.client.sklearndatabase)
+            ensure_job_indexes(self.client.sklearndatabase)
+            # database with labeledinstances, models; every call goes through
+            # a thread pool so handlers can await it without blocking the IOLoop
+            self.db = AsyncDatabase(self.client.sklearndatabase, ThreadPoolExecutor(options.db_workers))
+            # fitted models live in GridFS, db.models only references them
+            self.store = ModelStore(self.client.sklearndatabase, options.model_dir, options.model_compress)
             
         except ServerSelectionTimeoutError as inst:
             print('Could not initialize database connection, stopping execution')
             print('Are you running a valid local-hosted instance of mongodb?')
+
+        # per-stage request timings for /metrics, and profiles of slow requests
+        self.metrics = Metrics(self)
+        self.profiler = SlowRequestProfiler(options.profile_slow_ms / 1000.0)
+
+        # repeated PredictOne clips are answered from here, until their model changes
+        self.predictions = PredictionCache(options.prediction_cache_entries, options.prediction_cache_ttl_s)
+
+        # cache misses in PredictOne are filled here
+        self.loader = ModelLoader(self, models, self.predictions)
+
+        # concurrent PredictOne requests for the same model run as one batch
+        self.batcher = MicroBatcher(skh.predict_signals, options.batch_window_ms / 1000.0, options.max_batch)
+
+        # features for non-default mfcc parameters are computed here
+        self.features = FeatureQueue(self)
+
+        # bulk imports are featurized here
+        self.importer = make_executor(options.train_executor, options.import_workers)
+
+        # fitting happens here, never on the IOLoop
+        self.trainer = TrainingQueue(self, models, make_executor(options.train_executor, options.train_workers))
         
         settings = {
             'debug': True,
             'cookie_secret': 'D0N7_U$3_TH!$_1N_PR0D',
             "login_url": "/Authenticate",
+            'binary_features': options.binary_features,
+            'store_audio': options.store_audio,
+            'incremental_training': options.incremental_training,
         }
         tornado.web.Application.__init__(self, handlers, **settings)
 
@@ -79,10 +156,26 @@ class Application(tornado.web.Application):
 
 def main():
     '''Create server, begin IOLoop 
+       With --processes the listening socket is bound first and then
+       shared by forked workers, each with its own Application (mongo
+       connection, pools, model cache). Models are memory-mapped from the
+       same files in --model_dir, so their arrays sit in the page cache
+       once, and each worker polls db.models to drop models another worker
+       retrained
     '''
     tornado.options.parse_command_line()
-    http_server = HTTPServer(Application(), xheaders=True)
-    http_server.listen(options.port)
+    sockets = bind_sockets(options.port)
+    if options.processes != 1:
+        # fork before anything opens connections or starts threads
+        tornado.process.fork_processes(options.processes)
+    app = Application()
+    app.metrics.watch_mfcc()
+    http_server = HTTPServer(app, xheaders=True)
+    http_server.add_sockets(sockets)
+    if options.model_poll_s:
+        app.loader.watch(options.model_poll_s)
+    if options.warm_models:
+        IOLoop.current().spawn_callback(app.loader.warm_up, options.warm_models)
     IOLoop.instance().start()
 
 if __name__ == "__main__":
@@ -0,0 +1,353 @@
+#!/usr/bin/python
+'''Background training for UpdateModel so fitting never runs on the IOLoop'''
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import time
+import uuid
+
+from pymongo import ReturnDocument
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from dataset import load_instances, mark_fitted
+from features import DEFAULT_KEY, instance_source, mfcc_key, mfcc_params
+from jobs import JobBoard
+from modelstore import stored_classifiers
+
+from sklearn.linear_model import SGDClassifier
+from sklearn.svm import SVC
+from sklearn.neighbors import KNeighborsClassifier
+import numpy as np
+
+from knnbackends import make_knn
+
+# classifier slots UpdateModel knows how to build, keyed like the request body
+CLASSIFIERS = {
+    'knn': make_knn, # kwargs may pick a neighbour-search "backend"
+    'svm': SVC,
+    'sgd': SGDClassifier,
+}
+
+def make_executor(kind='process', workers=2):
+    '''Pool the estimators are fitted in. Use "thread" for estimators
+       that release the GIL while fitting
+    '''
+    if kind == 'process':
+        return ProcessPoolExecutor(max_workers=workers)
+    elif kind == 'thread':
+        return ThreadPoolExecutor(max_workers=workers)
+    raise ValueError("Unknown executor kind %s" % kind)
+
+def fit_classifier(key, params, f, l):
+    '''Fit one classifier (runs inside the pool)
+       returns the fitted model and its resubstitution accuracy
+    '''
+    clf = CLASSIFIERS[key](**params)
+    clf.fit(f, l)
+    lstar = clf.predict(f)
+    return clf, sum(lstar == l) / float(len(l))
+
+def update_classifier(key, params, clf, f, l):
+    '''Fold new instances into a fitted classifier without
+       revisiting the instances it was trained on (runs inside the pool).
+       KNN appends to its stored training set and rebuilds its index (the
+       approximate backends do this in extend), estimators with
+       partial_fit take one more pass over the new data.
+       Returns the model and its accuracy on the new instances,
+       raises NeedsRefit when only a full refit will do
+    '''
+    if isinstance(clf, KNeighborsClassifier):
+        # sklearn keeps the training set in private attributes, if a
+        # release renames them we refit rather than fail
+        fit_X, fit_y = getattr(clf, '_fit_X', None), getattr(clf, '_y', None)
+        if fit_X is None or fit_y is None:
+            raise NeedsRefit(key)
+        f_all = np.concatenate((fit_X, f))
+        l_all = np.concatenate((clf.classes_[fit_y], l))
+        clf = CLASSIFIERS[key](**params).fit(f_all, l_all)
+    elif hasattr(clf, 'extend'):
+        try:
+            clf.extend(f, l)
+        except AttributeError:
+            # stored before the estimator kept what extend needs
+            raise NeedsRefit(key)
+    elif hasattr(clf, 'partial_fit') and set(l) <= set(clf.classes_):
+        clf.partial_fit(f, l)
+    else:
+        raise NeedsRefit(key)
+    lstar = clf.predict(f)
+    return clf, sum(lstar == l) / float(len(l))
+
+
+class TrainingError(Exception):
+    '''Training could not run on the data we have, message goes to the client'''
+    pass
+
+
+class NeedsRefit(Exception):
+    '''An incremental update is not possible, refit from the whole dataset'''
+    pass
+
+
+class TrainingJob():
+    def __init__(self, dsid, params, incremental=False, mfcc=None):
+        self.job_id = uuid.uuid4().hex
+        self.dsid = dsid
+        self.params = params # {'knn': {...}, 'svm': {...}}
+        self.mfcc = mfcc_params(mfcc) # features the models are fitted on
+        self.incremental = incremental # try to only fit instances added since the last job
+        self.mode = None # 'incremental' or 'full' once we know
+        self.instances = 0 # instances fitted by this job
+        self.status = 'queued' # queued -> [featurizing ->] loading -> training -> saving -> done | failed
+        self.started = None # once set, later requests no longer join this job
+        self.steps_done = 0
+        self.accuracy = {}
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.done = Future() # resolves once the job is done or failed
+
+    @property
+    def progress(self):
+        # loading, one step per classifier, saving
+        return self.steps_done / float(len(self.params) + 2)
+
+    def to_json(self):
+        res = {"job_id": self.job_id,
+               "dsid": self.dsid,
+               "status": self.status,
+               "mode": self.mode,
+               "params": self.params,
+               "incremental": self.incremental,
+               "mfcc": self.mfcc,
+               "instances": self.instances,
+               "progress": round(self.progress, 3),
+               "created": self.created,
+               "started": self.started,
+               "finished": self.finished}
+        for key, acc in self.accuracy.items():
+            res[key] = str(acc)
+        if self.error:
+            res["error"] = self.error
+        return res
+
+
+class TrainingQueue():
+    '''Runs retrain jobs in an executor and publishes their status to
+       db.jobs, where every worker process can read it (see jobs.py).
+       At most one job per dsid runs at a time, and at most one more waits
+       behind it: retrain requests that arrive while a job is still
+       queued join that job (latest params win) instead of adding another,
+       whichever worker they reach
+    '''
+    def __init__(self, application, models, executor, history=200):
+        self.application = application
+        self.models = models
+        self.executor = executor
+        self.board = JobBoard(application, 'training', history=history)
+
+    @property
+    def db(self):
+        return self.application.db
+
+    @property
+    def store(self):
+        return self.application.store
+
+    async def submit(self, dsid, params, incremental=False, mfcc=None):
+        '''Queue a retrain of dsid with {clf_name: kwargs} on features
+           computed with the mfcc parameters, returns the job_id
+        '''
+        lock = "training:%s" % dsid
+        mfcc = mfcc_params(mfcc)
+        while True:
+            job = TrainingJob(dsid, params, incremental, mfcc)
+            await self.board.publish(job)
+            holder = await self.board.claim(lock, 'queued', job.job_id)
+            if holder == job.job_id:
+                break
+            await self.board.discard(job.job_id)
+            # join the job waiting on this dsid, unless it started meanwhile
+            res = await self.db.jobs.update_one({"_id": holder, "started": None},
+                                                {"$set": {"params": params, "incremental": incremental, "mfcc": mfcc}})
+            if res.matched_count:
+                return holder
+
+        self.board.add(job)
+        IOLoop.current().spawn_callback(self._run, job, lock)
+        return job.job_id
+
+    async def status(self, job_id):
+        return await self.board.status(job_id)
+
+    async def latest(self, dsid):
+        '''Status of the most recently submitted job for dsid'''
+        return await self.board.latest(dsid)
+
+    async def wait(self, job_id):
+        '''Status of a job once it is done or failed'''
+        return await self.board.wait(job_id)
+
+    async def _run(self, job, lock):
+        loop = IOLoop.current()
+        running = False
+        try:
+            # wait for the job ahead of us on this dsid
+            await self.board.move(lock, job.job_id, 'queued', 'running')
+            running = True
+            # from here on nobody joins, pick up what joined so far
+            doc = await self.db.jobs.find_one_and_update({"_id": job.job_id}, {"$set": {"started": time.time()}},
+                                                         return_document=ReturnDocument.AFTER)
+            job.params, job.incremental, job.mfcc, job.started = doc["params"], doc["incremental"], doc["mfcc"], doc["started"]
+
+            for key in job.params:
+                if key not in CLASSIFIERS:
+                    raise TrainingError("Unknown classifier %s" % key)
+
+            if mfcc_key(job.mfcc) != DEFAULT_KEY:
+                # fill in cached features for instances that do not have them yet
+                job.status = 'featurizing'
+                await self.board.publish(job)
+                features = self.application.features
+                features = await features.wait(await features.submit(job.dsid, job.mfcc))
+                if features is None or features["status"] == 'failed':
+                    raise TrainingError(features["error"] if features else "error computing features")
+
+            job.status = 'loading'
+            await self.board.publish(job)
+            fitted = None
+            previous = await self.db.models.find_one({"dsid":job.dsid})
+            if job.incremental and self.can_update(previous, job.params, job.mfcc):
+                fitted, ids = await self.update(job, previous)
+            if fitted is None:
+                fitted, ids = await self.refit(job)
+
+            job.status = 'saving'
+            await self.board.publish(job)
+            if fitted:
+                doc = await self.save_models(job.dsid, fitted, job.params, job.mfcc, previous)
+                collection, query = instance_source(self.db, job.dsid, job.mfcc)
+                await collection.run(mark_fitted, ids)
+                # swap the whole entry at once so predictions never see half a retrain,
+                # reading the models back maps their arrays from the stored files
+                models = await loop.run_in_executor(None, self.store.load, doc)
+                self.application.loader.put(job.dsid, models, doc["version"])
+                if previous:
+                    await loop.run_in_executor(None, self.store.delete, previous)
+            job.steps_done += 1
+            job.status = 'done'
+        except TrainingError as e:
+            job.status, job.error = 'failed', str(e)
+        except Exception as e:
+            print(e)
+            job.status, job.error = 'failed', "Need > data"
+        finally:
+            job.finished = time.time()
+            try:
+                await self.board.publish(job)
+                await self.board.release(lock, 'running' if running else 'queued', job.job_id)
+            finally:
+                job.done.set_result(job)
+
+    def can_update(self, previous, params, mfcc):
+        '''True if the stored models of a dsid were fitted with exactly these
+           classifiers, hyperparameters and features, anything else needs a
+           full refit
+        '''
+        if not previous:
+            return False
+        if previous.get('mfcc_params', mfcc_params()) != mfcc:
+            return False
+        if stored_classifiers(previous) != set(params):
+            return False
+        return all(previous.get(key+'_params') == value for key, value in params.items())
+
+    async def update(self, job, previous):
+        '''Incremental job: only load and fit the instances added since the
+           stored models were fitted. Returns (None, None) when some
+           classifier cannot be updated in place
+        '''
+        job.mode = 'incremental'
+        collection, query = instance_source(self.db, job.dsid, job.mfcc)
+        f, l, ids = await collection.run(load_instances, dict(query, fitted={"$ne":True}))
+        job.instances = len(l)
+        job.steps_done += 1
+
+        job.status = 'training'
+        await self.board.publish(job)
+        if not len(l):
+            # nothing new, the stored models are current
+            job.steps_done += len(job.params)
+            return {}, ids
+
+        loop = IOLoop.current()
+        # copy on write, partial_fit changes the arrays in place
+        stored = await loop.run_in_executor(None, self.store.load, previous, 'c')
+        futures = [(key, loop.run_in_executor(self.executor, update_classifier, key, params, stored[key], f, l))
+                   for key, params in job.params.items()]
+        fitted = {}
+        try:
+            for key, future in futures:
+                fitted[key], job.accuracy[key] = await future
+                job.steps_done += 1
+                await self.board.publish(job)
+        except NeedsRefit:
+            job.steps_done, job.accuracy = 0, {}
+            return None, None
+        return fitted, ids
+
+    async def refit(self, job):
+        '''Full job: fit every classifier from the whole dataset'''
+        job.mode = 'full'
+        collection, query = instance_source(self.db, job.dsid, job.mfcc)
+        f, l, ids = await collection.run(load_instances, query)
+        job.instances = len(l)
+        if len(set(l)) < 2:
+            raise TrainingError("Need > class labels")
+        job.steps_done += 1
+
+        # fit every classifier in the pool, they run side by side
+        job.status = 'training'
+        await self.board.publish(job)
+        loop = IOLoop.current()
+        futures = [(key, loop.run_in_executor(self.executor, fit_classifier, key, params, f, l))
+                   for key, params in job.params.items()]
+        fitted = {}
+        for key, future in futures:
+            fitted[key], job.accuracy[key] = await future
+            job.steps_done += 1
+            await self.board.publish(job)
+        return fitted, ids
+
+    async def save_models(self, dsid, fitted, params, mfcc, previous=None):
+        '''Store fitted models for dsid under a new version, with the
+           hyperparameters and mfcc parameters they were fitted with.
+           Returns the new document. The write only goes through if the
+           stored version is still the one we started from, another worker
+           process may have retrained the dsid in the meantime
+        '''
+        version = (previous or {}).get('version', 0) + 1
+        files = await IOLoop.current().run_in_executor(None, self.store.save, dsid, version, fitted)
+        set_obj = {"version": version,
+                   "mfcc_params": mfcc, # PredictOne featurizes with these
+                   "updated": time.time()} # for warming up the most recent models
+        for key in fitted:
+            set_obj[key+'_params'] = params[key]
+        set_obj.update(files)
+        unset_obj = {}
+        for key in CLASSIFIERS:
+            # pickles from before the model store
+            unset_obj[key+'_model'] = ""
+            if key not in fitted:
+                # classifiers left out of this job are no longer part of the dsid
+                unset_obj[key+'_file'] = ""
+                unset_obj[key+'_params'] = ""
+        update = {"$set": set_obj, "$unset": unset_obj}
+        if previous is None:
+            await self.db.models.update_one({"dsid":dsid}, update, upsert=True)
+        else:
+            res = await self.db.models.update_one({"dsid":dsid, "version":previous.get('version')}, update)
+            if not res.matched_count:
+                await IOLoop.current().run_in_executor(None, self.store.delete, dict(set_obj, dsid=dsid))
+                raise TrainingError("Models were updated by another worker, retry")
+        return dict(set_obj, dsid=dsid)
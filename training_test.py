@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import KNeighborsClassifier
+
+from knnbackends import PCANeighborsClassifier
+from training import NeedsRefit, update_classifier
+
+
+def dataset(n, seed=0):
+    rng = np.random.RandomState(seed)
+    labels = np.array(["low", "high"])[np.arange(n) % 2]
+    return rng.normal(size=(n, 20)) + (labels == "high")[:, None] * 5, labels
+
+
+def test_exact_knn_update_appends_instances():
+    f, l = dataset(20)
+    knn = KNeighborsClassifier(n_neighbors=1).fit(f[:10], l[:10])
+    knn, acc = update_classifier('knn', {"n_neighbors": 1}, knn, f[10:], l[10:])
+    assert knn.n_samples_fit_ == 20 and acc == 1.0
+
+    # a sklearn release without the private training set attributes
+    del knn._fit_X
+    with pytest.raises(NeedsRefit):
+        update_classifier('knn', {"n_neighbors": 1}, knn, f[:2], l[:2])
+
+
+def test_pca_knn_update_keeps_its_own_training_set():
+    f, l = dataset(20)
+    params = {"backend": "pca", "n_neighbors": 1, "n_components": 4}
+    knn = PCANeighborsClassifier(n_neighbors=1, n_components=4).fit(f[:10], l[:10])
+    knn, acc = update_classifier('knn', params, knn, f[10:], l[10:])
+    assert len(knn.Z_) == len(knn.y_) == 20 and acc == 1.0
+
+    # stored before the projected training set was kept
+    del knn.Z_
+    with pytest.raises(NeedsRefit):
+        update_classifier('knn', params, knn, f[:2], l[:2])